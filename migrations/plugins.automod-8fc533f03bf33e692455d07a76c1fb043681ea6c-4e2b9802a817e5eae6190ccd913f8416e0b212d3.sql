@@ -0,0 +1,7 @@
+CREATE TABLE automod.rule_stats
+    ( rule_id BIGINT NOT NULL PRIMARY KEY REFERENCES automod.rules (id)
+    , matches BIGINT NOT NULL
+    , actions BIGINT NOT NULL
+    , samples BIGINT NOT NULL
+    , match_time DOUBLE PRECISION NOT NULL
+    );
@@ -0,0 +1,53 @@
+ALTER TABLE factoids.factoids ADD COLUMN search_vector TSVECTOR;
+
+CREATE INDEX factoids_search_vector ON factoids.factoids USING GIN (search_vector);
+
+CREATE FUNCTION factoids.compute_search_vector(p_id INTEGER, p_text TEXT, p_embed JSONB)
+RETURNS TSVECTOR AS $compute_search_vector$
+	SELECT setweight(to_tsvector('english',
+			COALESCE((SELECT string_agg(name, ' ') FROM factoids.aliases WHERE id = p_id), '')), 'A')
+		|| setweight(to_tsvector('english', COALESCE(p_text, '')), 'B')
+		|| setweight(COALESCE(jsonb_to_tsvector('english', p_embed, '["string"]'), ''), 'C')
+$compute_search_vector$ LANGUAGE sql STABLE;
+
+CREATE FUNCTION factoids.update_factoid_search_vector()
+RETURNS TRIGGER AS $update_factoid_search_vector$
+	BEGIN
+		NEW.search_vector := factoids.compute_search_vector(NEW.id, NEW.message_text, NEW.embed_data);
+		RETURN NEW;
+	END
+$update_factoid_search_vector$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_search_vector
+	BEFORE INSERT OR UPDATE OF message_text, embed_data ON
+		factoids.factoids
+	FOR EACH ROW
+	EXECUTE PROCEDURE
+		factoids.update_factoid_search_vector();
+
+CREATE FUNCTION factoids.update_alias_search_vector()
+RETURNS TRIGGER AS $update_alias_search_vector$
+	BEGIN
+		IF TG_OP <> 'DELETE' THEN
+			UPDATE factoids.factoids
+				SET search_vector = factoids.compute_search_vector(id, message_text, embed_data)
+				WHERE id = NEW.id;
+		END IF;
+		IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.id <> NEW.id) THEN
+			UPDATE factoids.factoids
+				SET search_vector = factoids.compute_search_vector(id, message_text, embed_data)
+				WHERE id = OLD.id;
+		END IF;
+		RETURN NULL;
+	END
+$update_alias_search_vector$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_search_vector
+	AFTER INSERT OR DELETE OR UPDATE OF name, id ON
+		factoids.aliases
+	FOR EACH ROW
+	EXECUTE PROCEDURE
+		factoids.update_alias_search_vector();
+
+UPDATE factoids.factoids
+	SET search_vector = factoids.compute_search_vector(id, message_text, embed_data);
@@ -0,0 +1 @@
+CREATE INDEX files_local_filename ON log.files USING BTREE (local_filename);
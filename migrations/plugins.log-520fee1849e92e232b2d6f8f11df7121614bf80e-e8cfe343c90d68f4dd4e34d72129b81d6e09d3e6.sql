@@ -0,0 +1,5 @@
+CREATE TABLE log.dictionaries (
+	id SERIAL NOT NULL, 
+	data BYTEA NOT NULL, 
+	PRIMARY KEY (id)
+);
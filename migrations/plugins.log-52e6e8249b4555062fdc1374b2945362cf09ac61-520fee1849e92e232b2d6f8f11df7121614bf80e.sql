@@ -0,0 +1,45 @@
+ALTER TABLE log.files DROP CONSTRAINT files_message_id_fkey;
+
+ALTER TABLE log.messages RENAME TO messages_legacy;
+ALTER INDEX log.messages_pkey RENAME TO messages_legacy_pkey;
+ALTER INDEX log.messages_author_id RENAME TO messages_legacy_author_id;
+ALTER TABLE log.files RENAME TO files_legacy;
+ALTER INDEX log.files_pkey RENAME TO files_legacy_pkey;
+ALTER INDEX log.files_local_filename RENAME TO files_legacy_local_filename;
+
+CREATE TABLE log.messages (
+	id BIGINT NOT NULL, 
+	channel_id BIGINT NOT NULL, 
+	author_id BIGINT NOT NULL, 
+	username TEXT NOT NULL, 
+	nick TEXT, 
+	content BYTEA NOT NULL, 
+	PRIMARY KEY (id)
+)
+ PARTITION BY RANGE (id);
+CREATE TABLE log.files (
+	id BIGINT NOT NULL, 
+	message_id BIGINT NOT NULL, 
+	filename TEXT NOT NULL, 
+	url TEXT NOT NULL, 
+	local_filename TEXT, 
+	PRIMARY KEY (id)
+)
+ PARTITION BY RANGE (id);
+CREATE TABLE log.messages_default PARTITION OF log.messages DEFAULT;
+CREATE TABLE log.files_default PARTITION OF log.files DEFAULT;
+CREATE INDEX messages_author_id ON log.messages USING BTREE (author_id);
+CREATE INDEX files_local_filename ON log.files USING BTREE (local_filename);
+
+-- The existing data becomes a single partition covering everything up to the end of the current day, daily partitions
+-- are created by the bot from then on. Its rows are deleted individually as they expire, and the partition is dropped
+-- once all of its range has expired.
+DO $$
+DECLARE
+	bound BIGINT := (EXTRACT(EPOCH FROM date_trunc('day', now() AT TIME ZONE 'UTC') + INTERVAL '1 day')::BIGINT * 1000
+		- 1420070400000) << 22;
+BEGIN
+	EXECUTE format('ALTER TABLE log.messages ATTACH PARTITION log.messages_legacy FOR VALUES FROM (MINVALUE) TO (%s)', bound);
+	EXECUTE format('ALTER TABLE log.files ATTACH PARTITION log.files_legacy FOR VALUES FROM (MINVALUE) TO (%s)', bound);
+END
+$$;
@@ -0,0 +1,3 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX users_name_trgm ON log.users USING GIN (LOWER(username || '#' || discrim) gin_trgm_ops);
+CREATE INDEX nicks_nick_trgm ON log.nicks USING GIN (LOWER(nick) gin_trgm_ops);
@@ -0,0 +1,6 @@
+CREATE TABLE phish.snapshot (
+    id BIGINT GENERATED ALWAYS AS (0) STORED NOT NULL,
+    domains BYTEA NOT NULL,
+    updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (id)
+);
@@ -0,0 +1,5 @@
+ALTER TABLE tickets.tickets ADD COLUMN expires_at TIMESTAMP GENERATED ALWAYS AS (created_at + duration * INTERVAL '1 second') STORED;
+
+CREATE INDEX tickets_expires_at ON tickets.tickets USING BTREE (expires_at) WHERE status = 'IN_EFFECT';
+CREATE INDEX tickets_targetid_status ON tickets.tickets USING BTREE (targetid, status);
+CREATE INDEX tickets_list_msgid ON tickets.tickets USING BTREE (list_msgid);
@@ -1,17 +1,33 @@
 import asyncio
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 import enum
 import logging
 import re
-from typing import TYPE_CHECKING, Dict, Iterable, List, Literal, Optional, Set, Union, cast
+from time import perf_counter
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 
 import discord
-from discord import AllowedMentions, Guild, Member, Message
+from discord import AllowedMentions, Guild, Member, Message, StageChannel, TextChannel, Thread, VoiceChannel
 from discord.abc import Snowflake
 from discord.ext.commands import Greedy, group
 import discord.utils
-from sqlalchemy import ARRAY, TEXT, BigInteger, Enum, select
-from sqlalchemy.dialects.postgresql import INTERVAL
+from sqlalchemy import ARRAY, TEXT, BigInteger, Enum, ForeignKey, func, select
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION, INTERVAL, insert
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 import sqlalchemy.orm
 from sqlalchemy.orm import Mapped, mapped_column
@@ -21,6 +37,7 @@ from bot.acl import privileged
 from bot.client import client
 from bot.commands import Context, cleanup, plugin_command
 import bot.message_tracker
+from bot.tasks import task
 import plugins
 import plugins.phish
 import plugins.tickets
@@ -95,11 +112,106 @@ class ExemptRole:
         def __init__(self, *, role_id: int) -> None: ...
 
 
+@registry.mapped
+class RuleStats:
+    __tablename__ = "rule_stats"
+    __table_args__ = {"schema": "automod"}
+
+    rule_id: Mapped[int] = mapped_column(BigInteger, ForeignKey(Rule.id), primary_key=True, autoincrement=False)
+    matches: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    actions: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    samples: Mapped[int] = mapped_column(BigInteger, nullable=False)  # How many messages were timed against the rule
+    match_time: Mapped[float] = mapped_column(DOUBLE_PRECISION, nullable=False)  # Seconds spent on those messages
+
+    if TYPE_CHECKING:
+
+        def __init__(self, *, rule_id: int, matches: int, actions: int, samples: int, match_time: float) -> None: ...
+
+
 active_rules: Dict[int, Rule]
 regex: re.Pattern[str]
+rule_regexes: Dict[int, re.Pattern[str]]
 exempt_roles: Set[int]
 
 
+@dataclass
+class StatsDelta:
+    matches: int = 0
+    actions: int = 0
+    samples: int = 0
+    match_time: float = 0.0
+
+
+# Statistics accumulated since the last write to the database
+pending_stats: Dict[int, StatsDelta] = {}
+
+# Matching every message against every rule separately would defeat the purpose of the combined regex, so only every
+# so many messages are timed against each rule individually.
+STATS_SAMPLE_INTERVAL: int = 100
+
+messages_scanned: int = 0
+
+
+def stats_for(rule_id: int) -> StatsDelta:
+    if (stats := pending_stats.get(rule_id)) is None:
+        stats = pending_stats[rule_id] = StatsDelta()
+    return stats
+
+
+def sample_match_time(text: str) -> None:
+    for rule_id, rule_regex in rule_regexes.items():
+        start = perf_counter()
+        rule_regex.search(text)
+        stats = stats_for(rule_id)
+        stats.samples += 1
+        stats.match_time += perf_counter() - start
+
+
+@task(name="Automod stats task", every=300, exc_backoff_base=60)
+async def stats_task() -> None:
+    await flush_stats()
+
+
+async def flush_stats() -> None:
+    global pending_stats
+    if not pending_stats:
+        return
+    deltas, pending_stats = pending_stats, {}
+    try:
+        async with sessionmaker() as session:
+            stmt = insert(RuleStats).values(
+                [
+                    {
+                        "rule_id": rule_id,
+                        "matches": delta.matches,
+                        "actions": delta.actions,
+                        "samples": delta.samples,
+                        "match_time": delta.match_time,
+                    }
+                    for rule_id, delta in deltas.items()
+                ]
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[RuleStats.rule_id],
+                set_={
+                    "matches": RuleStats.matches + stmt.excluded.matches,
+                    "actions": RuleStats.actions + stmt.excluded.actions,
+                    "samples": RuleStats.samples + stmt.excluded.samples,
+                    "match_time": RuleStats.match_time + stmt.excluded.match_time,
+                },
+            )
+            await session.execute(stmt)
+            await session.commit()
+    except:
+        for rule_id, delta in deltas.items():
+            stats = stats_for(rule_id)
+            stats.matches += delta.matches
+            stats.actions += delta.actions
+            stats.samples += delta.samples
+            stats.match_time += delta.match_time
+        raise
+
+
 def rule_to_regex(rule: Rule) -> str:
     if rule.type == MatchType.SUBSTRING:
         return r"|".join(re.escape(keyword) for keyword in rule.keywords)
@@ -110,7 +222,7 @@ def rule_to_regex(rule: Rule) -> str:
 
 
 async def rehash_rules(session: AsyncSession) -> None:
-    global active_rules, regex, exempt_roles
+    global active_rules, regex, rule_regexes, exempt_roles
     stmt = select(Rule).where(Rule.action != None).order_by(Rule.id)
     rules = (await session.execute(stmt)).scalars()
     stmt = select(ExemptRole.role_id)
@@ -123,6 +235,7 @@ async def rehash_rules(session: AsyncSession) -> None:
     for rule in active_rules.values():
         parts.append(r"(?P<_" + str(rule.id) + r">" + rule_to_regex(rule) + r")")
     regex = re.compile("|".join(parts), re.I) if parts else re.compile("(?!)")
+    rule_regexes = {rule.id: re.compile(rule_to_regex(rule), re.I) for rule in active_rules.values()}
 
 
 def parse_note(text: Optional[str]) -> Dict[int, int]:
@@ -142,29 +255,62 @@ def serialize_note(data: Dict[int, int]) -> str:
     return "Automod:\n" + "\n".join("pattern {} matched {} times".format(index, value) for index, value in data.items())
 
 
-async def do_create_automod_note(target_id: int, index: int) -> None:
+async def write_automod_note(target_id: int, counts: Dict[int, int]) -> None:
     async with plugins.tickets.sessionmaker() as session:
         assert client.user is not None
         notes = await plugins.tickets.find_notes_prefix(session, "Automod:\n", modid=client.user.id, targetid=target_id)
         if len(notes) == 0:
             await plugins.tickets.create_note(
-                session, serialize_note({index: 1}), modid=client.user.id, targetid=target_id, approved=True
+                session, serialize_note(counts), modid=client.user.id, targetid=target_id, approved=True
             )
         else:
             data = parse_note(notes[-1].comment)
-            data[index] = 1 + data.get(index, 0)
+            for index, count in counts.items():
+                data[index] = count + data.get(index, 0)
             notes[-1].comment = serialize_note(data)
         async with plugins.tickets.Ticket.publish_all(session):
             await session.commit()
         await session.commit()
 
 
+# How long to wait for more actions of the same kind before dispatching them together. During a spam wave this turns
+# many individual API calls and ticket writes into a few batched ones.
+BATCH_DELAY: float = 1.0
+
+# Pattern match counts not yet written to the automod note, per target user. The presence of a key means a writer task
+# is running for that target; the dict is swapped out for an empty one whenever the writer picks up the counts.
+pending_notes: Dict[int, Dict[int, int]] = {}
+
+
+async def do_create_automod_notes(target_id: int) -> None:
+    try:
+        await asyncio.sleep(BATCH_DELAY)
+        while counts := pending_notes[target_id]:
+            pending_notes[target_id] = {}
+            try:
+                await write_automod_note(target_id, counts)
+            except:
+                logger.error(format("Could not update automod note for {!m}", target_id), exc_info=True)
+    finally:
+        del pending_notes[target_id]
+
+
 def fork_create_automod_note(target_id: int, index: int) -> None:
-    asyncio.create_task(do_create_automod_note(target_id, index), name=format("Automod note {!m}", target_id))
+    if target_id not in pending_notes:
+        pending_notes[target_id] = {}
+        asyncio.create_task(do_create_automod_notes(target_id), name=format("Automod note {!m}", target_id))
+    counts = pending_notes[target_id]
+    counts[index] = 1 + counts.get(index, 0)
 
 
 URL_regex: re.Pattern[str] = re.compile(r"https?://([^/]*)/?\S*", re.I)
 
+# Messages not yet deleted, per channel. Same protocol as pending_notes.
+pending_deletes: Dict[int, Dict[int, Message]] = {}
+
+# Discord refuses to bulk delete messages older than 2 weeks, leave some margin
+BULK_DELETE_MAX_AGE: timedelta = timedelta(days=13)
+
 
 async def do_delete_message(msg: Message) -> None:
     try:
@@ -175,8 +321,90 @@ async def do_delete_message(msg: Message) -> None:
         logger.error("Could not delete message {}".format(msg.jump_url), exc_info=True)
 
 
+async def do_bulk_delete(channel: Union[TextChannel, Thread, VoiceChannel, StageChannel], msgs: List[Message]) -> None:
+    try:
+        await retry(lambda: channel.delete_messages(msgs), attempts=10)
+    except discord.NotFound:
+        # One of the messages is already gone, which fails the whole request
+        for msg in msgs:
+            await do_delete_message(msg)
+    except discord.Forbidden:
+        logger.error(format("Could not delete {} messages in {!c}", len(msgs), channel.id), exc_info=True)
+
+
+async def delete_messages(msgs: List[Message]) -> None:
+    channel = msgs[0].channel
+    if isinstance(channel, (TextChannel, Thread, VoiceChannel, StageChannel)):
+        cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        bulk = [msg for msg in msgs if msg.created_at > cutoff]
+        for i in range(0, len(bulk), 100):
+            await do_bulk_delete(channel, bulk[i : i + 100])
+        msgs = [msg for msg in msgs if msg.created_at <= cutoff]
+    for msg in msgs:
+        await do_delete_message(msg)
+
+
+async def do_delete_messages(channel_id: int) -> None:
+    try:
+        await asyncio.sleep(BATCH_DELAY)
+        while msgs := pending_deletes[channel_id]:
+            pending_deletes[channel_id] = {}
+            try:
+                await delete_messages(list(msgs.values()))
+            except:
+                logger.error(format("Could not delete messages in {!c}", channel_id), exc_info=True)
+    finally:
+        del pending_deletes[channel_id]
+
+
 def fork_delete_message(msg: Message) -> None:
-    asyncio.create_task(do_delete_message(msg), name="Automod cleanup {}".format(msg.id))
+    if msg.channel.id not in pending_deletes:
+        pending_deletes[msg.channel.id] = {}
+        asyncio.create_task(do_delete_messages(msg.channel.id), name=format("Automod cleanup {!c}", msg.channel.id))
+    pending_deletes[msg.channel.id][msg.id] = msg
+
+
+# Actions against a user that are in progress or have recently completed, per (guild, user), with the time the action
+# expires (None if it doesn't). A user that is already being banned doesn't need to be kicked or timed out, and repeated
+# matches shouldn't repeat the same action, unless the new action lasts longer.
+user_actions: Dict[Tuple[int, int], Tuple[ActionType, Optional[datetime], asyncio.Task[None]]] = {}
+
+action_severity: Dict[ActionType, int] = {ActionType.MUTE: 0, ActionType.KICK: 1, ActionType.BAN: 2}
+
+# How long a completed action keeps suppressing weaker ones, to absorb messages that were already in flight
+ACTION_LINGER: float = 10.0
+
+
+def fork_user_action(
+    guild: Guild,
+    user: Snowflake,
+    action: ActionType,
+    until: Optional[datetime],
+    coro: Callable[[], Coroutine[Any, Any, None]],
+    name: str,
+) -> None:
+    key = (guild.id, user.id)
+    if (pending := user_actions.get(key)) is not None:
+        pending_action, pending_until, _ = pending
+        if action_severity[pending_action] >= action_severity[action] and (
+            pending_until is None or (until is not None and pending_until >= until)
+        ):
+            return
+    task = asyncio.create_task(coro(), name=name)
+    user_actions[key] = (action, until, task)
+
+    def forget() -> None:
+        if key in user_actions and user_actions[key][2] is task:
+            del user_actions[key]
+
+    def done(_: asyncio.Task[None]) -> None:
+        # A failed action shouldn't prevent another attempt
+        if task.cancelled() or task.exception() is not None:
+            forget()
+        else:
+            asyncio.get_running_loop().call_later(ACTION_LINGER, forget)
+
+    task.add_done_callback(done)
 
 
 async def do_kick_user(guild: Guild, user: Snowflake, reason: str) -> None:
@@ -189,7 +417,9 @@ async def do_kick_user(guild: Guild, user: Snowflake, reason: str) -> None:
 
 
 def fork_kick_user(guild: Guild, user: Snowflake, reason: str) -> None:
-    asyncio.create_task(do_kick_user(guild, user, reason), name=format("Automod kick {!m}", user))
+    fork_user_action(
+        guild, user, ActionType.KICK, None, lambda: do_kick_user(guild, user, reason), format("Automod kick {!m}", user)
+    )
 
 
 async def do_ban_user(guild: Guild, user: Snowflake, reason: str) -> None:
@@ -202,11 +432,15 @@ async def do_ban_user(guild: Guild, user: Snowflake, reason: str) -> None:
 
 
 def fork_ban_user(guild: Guild, user: Snowflake, duration: Optional[timedelta], reason: str) -> None:
+    until = None
     if duration is not None:
+        until = discord.utils.utcnow() + duration
         reason = "Banned by {}: {} seconds, {}".format(
             client.user.id if client.user else None, int(duration.total_seconds()), reason
         )
-    asyncio.create_task(do_ban_user(guild, user, reason), name=format("Automod ban {!m}", user))
+    fork_user_action(
+        guild, user, ActionType.BAN, until, lambda: do_ban_user(guild, user, reason), format("Automod ban {!m}", user)
+    )
 
 
 async def do_time_out(member: Member, until: datetime, reason: str) -> None:
@@ -220,7 +454,14 @@ async def do_time_out(member: Member, until: datetime, reason: str) -> None:
 
 def fork_time_out(member: Member, duration: timedelta, reason: str) -> None:
     until = discord.utils.utcnow() + duration
-    asyncio.create_task(do_time_out(member, until, reason), name=format("Automod mute {!m}", member))
+    fork_user_action(
+        member.guild,
+        member,
+        ActionType.MUTE,
+        until,
+        lambda: do_time_out(member, until, reason),
+        format("Automod mute {!m}", member),
+    )
 
 
 def phish_match(msg: Message, text: str) -> None:
@@ -241,6 +482,7 @@ async def resolve_link(msg: Message, link: str) -> None:
 
 
 async def process_messages(msgs: Iterable[Message]) -> None:
+    global messages_scanned
     for msg in msgs:
         if msg.guild is None:
             continue
@@ -248,6 +490,10 @@ async def process_messages(msgs: Iterable[Message]) -> None:
             continue
 
         try:
+            messages_scanned += 1
+            if messages_scanned % STATS_SAMPLE_INTERVAL == 0:
+                sample_match_time(msg.content)
+
             match: Optional[re.Match[str]]
             resolve_links: Set[str] = set()
             for match in URL_regex.finditer(msg.content):
@@ -267,10 +513,12 @@ async def process_messages(msgs: Iterable[Message]) -> None:
                 else:
                     continue
                 logger.info("Message {} matches pattern {}".format(msg.id, index))
+                stats_for(index).matches += 1
                 if isinstance(msg.author, Member):
                     if any(role.id in exempt_roles for role in msg.author.roles):
                         continue
                 if (rule := active_rules.get(index)) is not None:
+                    stats_for(index).actions += 1
                     # include a portion of the message content for context
                     # we can't include the whole message if it's too long
                     # we limit the context to 128 characters, for safety
@@ -368,6 +616,30 @@ async def init() -> None:
         await bot.message_tracker.unsubscribe(__name__, None)
 
     plugins.finalizer(unsubscribe)
+    plugins.finalizer(flush_stats)
+
+
+async def count_overrides() -> Dict[int, int]:
+    """
+    Count how many times a moderator has reverted or hidden a ticket resulting from an automod action, per pattern.
+    """
+    if client.user is None:
+        return {}
+    pattern = func.substring(plugins.tickets.Ticket.comment, r"message matches pattern (\d+)")
+    async with plugins.tickets.sessionmaker() as session:
+        stmt = (
+            select(pattern, func.count())
+            .where(
+                plugins.tickets.Ticket.modid == client.user.id,
+                plugins.tickets.Ticket.status.in_(
+                    (plugins.tickets.TicketStatus.REVERTED, plugins.tickets.TicketStatus.HIDDEN)
+                ),
+                plugins.tickets.Ticket.modified_by != None,
+                pattern != None,
+            )
+            .group_by(pattern)
+        )
+        return {int(index): count for index, count in await session.execute(stmt)}
 
 
 @plugin_command
@@ -419,7 +691,13 @@ async def automod_exempt_remove(ctx: Context, role: PartialRoleConverter) -> Non
 @automod_command.command("list")
 @privileged
 async def automod_list(ctx: Context) -> None:
-    """List all automod patterns (CW)."""
+    """List all automod patterns (CW), with how often they matched, and how long they take to check."""
+    await flush_stats()
+    async with sessionmaker() as session:
+        stmt = select(RuleStats)
+        stats = {row.rule_id: row for row in (await session.execute(stmt)).scalars()}
+    overrides = await count_overrides()
+
     items = [PlainItem("**Automod patterns**:\n")]
     for rule in active_rules.values():
         if rule.action is None:
@@ -428,14 +706,28 @@ async def automod_list(ctx: Context) -> None:
             duration = " for {} seconds".format(rule.action_duration) if rule.action_duration else " permanently"
         else:
             duration = ""
+        if (rule_stats := stats.get(rule.id)) is not None:
+            summary = " ({} matches, {} actions, {} overridden, {})".format(
+                rule_stats.matches,
+                rule_stats.actions,
+                overrides.get(rule.id, 0),
+                (
+                    "{:.1f}\u00B5s per message".format(1e6 * rule_stats.match_time / rule_stats.samples)
+                    if rule_stats.samples
+                    else "not timed yet"
+                ),
+            )
+        else:
+            summary = " (no matches)"
         items.append(
             PlainItem(
-                "**{}**: {} {} -> {}{}\n".format(
+                "**{}**: {} {} -> {}{}{}\n".format(
                     rule.id,
                     rule.type.value,
                     ", ".join(format("||{!i}||", keyword) for keyword in rule.keywords),
                     rule.action.value,
                     duration,
+                    summary,
                 )
             )
         )
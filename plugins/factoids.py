@@ -1,28 +1,63 @@
+import asyncio
 from datetime import datetime
 import json
-from typing import TYPE_CHECKING, Literal, Mapping, Optional, TypedDict, Union, cast, overload
+import logging
+import re
+from time import perf_counter
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    List,
+    Literal,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypedDict,
+    TypeVar,
+    Union,
+    cast,
+    overload,
+)
 from typing_extensions import NotRequired
 
-from discord import AllowedMentions, Embed, Message, MessageReference, Thread
+from discord import AllowedMentions, Embed, Interaction, Message, MessageReference, Thread
 from discord.abc import GuildChannel
-from sqlalchemy import TEXT, TIMESTAMP, BigInteger, Computed, ForeignKey, Integer, delete, func, select
-from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from discord.app_commands import Choice
+from sqlalchemy import (
+    TEXT,
+    TIMESTAMP,
+    BigInteger,
+    Computed,
+    ForeignKey,
+    Integer,
+    bindparam,
+    delete,
+    func,
+    select,
+    update,
+)
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 import sqlalchemy.orm
 from sqlalchemy.orm import Mapped, aliased, mapped_column, raiseload, relationship
-from sqlalchemy.schema import CreateSchema
+from sqlalchemy.schema import DDL, CreateSchema
 
-from bot.acl import EvalResult, evaluate_acl, evaluate_ctx, privileged, register_action
+from bot.acl import EvalResult, evaluate_acl, evaluate_ctx, evaluate_interaction, privileged, register_action
 from bot.cogs import Cog, cog, group
 from bot.commands import Context, cleanup
 from bot.config import plugin_config_command
+from bot.interactions import command
 from bot.reactions import get_input, get_reaction
+from bot.tasks import task
 import plugins
 import util.db
 import util.db.kv
 from util.discord import CodeBlock, Inline, InvocationError, Quoted, UserError, format
 
 
+logger: logging.Logger = logging.getLogger(__name__)
+
 registry: sqlalchemy.orm.registry = sqlalchemy.orm.registry()
 
 sessionmaker = async_sessionmaker(util.db.engine, expire_on_commit=False)
@@ -59,6 +94,8 @@ class Factoid:
     uses: Mapped[int] = mapped_column(BigInteger, nullable=False)
     used_at: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP)
     flags: Mapped[Optional[Flags]] = mapped_column(JSONB)
+    # Maintained by triggers from the aliases, the text and the embed
+    search_vector: Mapped[Optional[str]] = mapped_column(TSVECTOR, deferred=True)
 
     if TYPE_CHECKING:
 
@@ -130,6 +167,47 @@ class Alias:
 
 
 prefix: Optional[str]
+# Names of all aliases, mapped to the factoid ID, so that we can find the alias an invocation refers to without asking
+# the database. The distinct lengths of the names are kept sorted in decreasing order, with the number of aliases of
+# each length: the longest matching alias is found by trying each length in turn.
+alias_ids: Dict[str, int]
+alias_lengths: List[int]
+alias_length_counts: Dict[int, int]
+# Uses of factoids and aliases that haven't been written to the database yet: the number of uses and the time of the
+# last use.
+factoid_uses: Dict[int, Tuple[int, datetime]] = {}
+alias_uses: Dict[str, Tuple[int, datetime]] = {}
+uses_lock: asyncio.Lock = asyncio.Lock()
+
+
+class Response(NamedTuple):
+    content: Optional[str]
+    embed: Optional[Embed]
+    mentions: AllowedMentions
+    acl: Optional[str]
+
+
+# Ready to send responses of factoids, by factoid ID. Filled on first use, invalidated when the factoid changes. Each
+# invalidation bumps the generation of the factoid, so that a response fetched before the change is not stored.
+responses: Dict[int, Response] = {}
+response_generations: Dict[int, int] = {}
+
+
+def invalidate_response(id: int) -> None:
+    responses.pop(id, None)
+    response_generations[id] = response_generations.get(id, 0) + 1
+
+
+def render_response(factoid: Factoid) -> Response:
+    mentions = AllowedMentions.none()
+    acl = None
+    if (flags := factoid.flags) is not None:
+        acl = flags.get("acl")
+        if flags.get("mentions"):
+            mentions = AllowedMentions(roles=True, users=True)
+    embed = Embed.from_dict(factoid.embed_data) if factoid.embed_data is not None else None
+    return Response(factoid.message_text, embed, mentions, acl)
+
 
 use_tags = register_action("use_tags")
 manage_tag_flags = register_action("manage_tag_flags")
@@ -137,8 +215,65 @@ manage_tag_flags = register_action("manage_tag_flags")
 
 @plugins.init
 async def init() -> None:
-    global prefix
-    await util.db.init(util.db.get_ddl(CreateSchema("factoids"), registry.metadata.create_all))
+    global prefix, alias_ids, alias_lengths, alias_length_counts
+    await util.db.init(
+        util.db.get_ddl(
+            CreateSchema("factoids"),
+            registry.metadata.create_all,
+            DDL(
+                """
+        CREATE INDEX factoids_search_vector ON factoids.factoids USING GIN (search_vector);
+
+        CREATE FUNCTION factoids.compute_search_vector(p_id INTEGER, p_text TEXT, p_embed JSONB)
+        RETURNS TSVECTOR AS $compute_search_vector$
+            SELECT setweight(to_tsvector('english',
+                    COALESCE((SELECT string_agg(name, ' ') FROM factoids.aliases WHERE id = p_id), '')), 'A')
+                || setweight(to_tsvector('english', COALESCE(p_text, '')), 'B')
+                || setweight(COALESCE(jsonb_to_tsvector('english', p_embed, '["string"]'), ''), 'C')
+        $compute_search_vector$ LANGUAGE sql STABLE;
+
+        CREATE FUNCTION factoids.update_factoid_search_vector()
+        RETURNS TRIGGER AS $update_factoid_search_vector$
+            BEGIN
+                NEW.search_vector := factoids.compute_search_vector(NEW.id, NEW.message_text, NEW.embed_data);
+                RETURN NEW;
+            END
+        $update_factoid_search_vector$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER update_search_vector
+            BEFORE INSERT OR UPDATE OF message_text, embed_data ON
+                factoids.factoids
+            FOR EACH ROW
+            EXECUTE PROCEDURE
+                factoids.update_factoid_search_vector();
+
+        CREATE FUNCTION factoids.update_alias_search_vector()
+        RETURNS TRIGGER AS $update_alias_search_vector$
+            BEGIN
+                IF TG_OP <> 'DELETE' THEN
+                    UPDATE factoids.factoids
+                        SET search_vector = factoids.compute_search_vector(id, message_text, embed_data)
+                        WHERE id = NEW.id;
+                END IF;
+                IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.id <> NEW.id) THEN
+                    UPDATE factoids.factoids
+                        SET search_vector = factoids.compute_search_vector(id, message_text, embed_data)
+                        WHERE id = OLD.id;
+                END IF;
+                RETURN NULL;
+            END
+        $update_alias_search_vector$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER update_search_vector
+            AFTER INSERT OR DELETE OR UPDATE OF name, id ON
+                factoids.aliases
+            FOR EACH ROW
+            EXECUTE PROCEDURE
+                factoids.update_alias_search_vector();
+        """
+            ),
+        )
+    )
 
     async with sessionmaker() as session:
         conf = await session.get(GlobalConfig, 0)
@@ -149,6 +284,153 @@ async def init() -> None:
 
         prefix = conf.prefix
 
+        alias_ids, alias_lengths, alias_length_counts = {}, [], {}
+        for name, id in await session.execute(select(Alias.name, Alias.id)):
+            add_alias(name, id)
+
+
+def add_alias(name: str, id: int) -> None:
+    if name not in alias_ids:
+        if (count := alias_length_counts.get(len(name), 0)) == 0:
+            alias_lengths.append(len(name))
+            alias_lengths.sort(reverse=True)
+        alias_length_counts[len(name)] = count + 1
+    alias_ids[name] = id
+
+
+def remove_alias(name: str) -> None:
+    if alias_ids.pop(name, None) is not None:
+        if (count := alias_length_counts.pop(len(name))) > 1:
+            alias_length_counts[len(name)] = count - 1
+        else:
+            alias_lengths.remove(len(name))
+
+
+K = TypeVar("K")
+
+
+def add_uses(pending: Dict[K, Tuple[int, datetime]], key: K, uses: int, used_at: datetime) -> None:
+    old_uses, old_used_at = pending.get(key, (0, used_at))
+    pending[key] = (old_uses + uses, max(old_used_at, used_at))
+
+
+def record_use(name: str, id: int) -> None:
+    now = datetime.utcnow()
+    add_uses(factoid_uses, id, 1, now)
+    add_uses(alias_uses, name, 1, now)
+
+
+async def flush_uses() -> None:
+    """Write the accumulated uses to the database, in one batch per table."""
+    global factoid_uses, alias_uses
+    async with uses_lock:
+        if not factoid_uses and not alias_uses:
+            return
+        factoids, aliases = factoid_uses, alias_uses
+        factoid_uses, alias_uses = {}, {}
+        try:
+            async with sessionmaker() as session:
+                conn = await session.connection()
+                if factoids:
+                    stmt = (
+                        update(Factoid)
+                        .where(Factoid.id == bindparam("b_id"))
+                        .values(uses=Factoid.uses + bindparam("b_uses"), used_at=bindparam("b_used_at"))
+                    )
+                    await conn.execute(
+                        stmt,
+                        [
+                            {"b_id": id, "b_uses": uses, "b_used_at": used_at}
+                            for id, (uses, used_at) in factoids.items()
+                        ],
+                    )
+                if aliases:
+                    stmt = (
+                        update(Alias)
+                        .where(Alias.name == bindparam("b_name"))
+                        .values(uses=Alias.uses + bindparam("b_uses"), used_at=bindparam("b_used_at"))
+                    )
+                    await conn.execute(
+                        stmt,
+                        [
+                            {"b_name": name, "b_uses": uses, "b_used_at": used_at}
+                            for name, (uses, used_at) in aliases.items()
+                        ],
+                    )
+                await session.commit()
+        except:
+            # Keep the uses for the next attempt
+            for id, (uses, used_at) in factoids.items():
+                add_uses(factoid_uses, id, uses, used_at)
+            for name, (uses, used_at) in aliases.items():
+                add_uses(alias_uses, name, uses, used_at)
+            raise
+
+
+@task(name="Factoid uses flush task", every=300, exc_backoff_base=60)
+async def flush_task() -> None:
+    await flush_uses()
+
+
+@plugins.finalizer
+async def flush_on_unload() -> None:
+    try:
+        await flush_uses()
+    except:
+        logger.error("Could not save factoid uses", exc_info=True)
+
+
+async def get_response(id: int) -> Optional[Response]:
+    if (response := responses.get(id)) is None:
+        generation = response_generations.get(id, 0)
+        async with sessionmaker() as session:
+            if (factoid := await session.get(Factoid, id)) is None:
+                return None
+        response = render_response(factoid)
+        if response_generations.get(id, 0) == generation:
+            responses[id] = response
+    return response
+
+
+SEARCH_LIMIT = 10
+AUTOCOMPLETE_LIMIT = 25
+
+search_word_re: re.Pattern[str] = re.compile(r"\w+")
+
+
+async def search_factoids(session: AsyncSession, text: str, limit: int) -> List[Tuple[str, int, Optional[str]]]:
+    """
+    Find factoids whose names or contents contain words starting with each of the given words. Returns the most used
+    alias, the number of uses and the ACL of each factoid, ordered by relevance weighted by uses.
+    """
+    if not (words := search_word_re.findall(text)):
+        return []
+    query = func.to_tsquery("english", " & ".join(word + ":*" for word in words))
+    aliases = aliased(Alias)
+    stmt = (
+        select(
+            select(aliases.name)
+            .where(aliases.id == Factoid.id)
+            .order_by(aliases.uses.desc())
+            .limit(1)
+            .scalar_subquery(),
+            Factoid.uses,
+            Factoid.flags["acl"].astext,
+        )
+        .where(Factoid.search_vector.op("@@")(query))
+        .order_by((func.ts_rank(Factoid.search_vector, query) * func.ln(Factoid.uses + 2)).desc())
+        .limit(limit)
+    )
+    return [(name, uses, acl) for name, uses, acl in await session.execute(stmt)]
+
+
+def match_alias(text: str) -> Optional[str]:
+    """Find the longest alias that is a prefix of the given text."""
+    for length in alias_lengths:
+        if length <= len(text) and text[:length] in alias_ids:
+            return text[:length]
+    return None
+
 
 @cog
 class Factoids(Cog):
@@ -167,48 +449,35 @@ class Factoids(Cog):
         text = " ".join(msg.content[len(prefix) :].split()).lower()
         if not len(text):
             return
-        async with sessionmaker() as session:
-            stmt = (
-                select(Alias)
-                .where(Alias.name == func.substring(text, 1, func.length(Alias.name)))
-                .order_by(func.length(Alias.name).desc())
-                .limit(1)
-            )
-            if (alias := (await session.execute(stmt)).scalar()) is None:
-                return
+        if (name := match_alias(text)) is None:
+            return
+        id = alias_ids[name]
+        if (response := await get_response(id)) is None:
+            return
 
-            mentions = AllowedMentions.none()
-            if (flags := alias.factoid.flags) is not None:
-                if "acl" in flags and evaluate_acl(flags["acl"], msg.author, msg.channel) != EvalResult.TRUE:
-                    return
-                if "mentions" in flags and flags["mentions"]:
-                    mentions = AllowedMentions(roles=True, users=True)
-
-            embed = Embed.from_dict(alias.factoid.embed_data) if alias.factoid.embed_data is not None else None
-            if msg.reference is not None and msg.reference.message_id is not None:
-                reference = MessageReference(
-                    guild_id=msg.reference.guild_id,
-                    channel_id=msg.reference.channel_id,
-                    message_id=msg.reference.message_id,
-                    fail_if_not_exists=False,
+        if response.acl is not None and evaluate_acl(response.acl, msg.author, msg.channel) != EvalResult.TRUE:
+            return
+
+        if msg.reference is not None and msg.reference.message_id is not None:
+            reference = MessageReference(
+                guild_id=msg.reference.guild_id,
+                channel_id=msg.reference.channel_id,
+                message_id=msg.reference.message_id,
+                fail_if_not_exists=False,
+            )
+            if response.embed is not None:
+                await msg.channel.send(
+                    response.content, embed=response.embed, reference=reference, allowed_mentions=response.mentions
                 )
-                if embed is not None:
-                    await msg.channel.send(
-                        alias.factoid.message_text, embed=embed, reference=reference, allowed_mentions=mentions
-                    )
-                else:
-                    await msg.channel.send(alias.factoid.message_text, reference=reference, allowed_mentions=mentions)
             else:
-                if embed is not None:
-                    await msg.channel.send(alias.factoid.message_text, embed=embed, allowed_mentions=mentions)
-                else:
-                    await msg.channel.send(alias.factoid.message_text, allowed_mentions=mentions)
-
-            alias.factoid.uses += 1
-            alias.factoid.used_at = datetime.utcnow()
-            alias.uses += 1
-            alias.used_at = datetime.utcnow()
-            await session.commit()
+                await msg.channel.send(response.content, reference=reference, allowed_mentions=response.mentions)
+        else:
+            if response.embed is not None:
+                await msg.channel.send(response.content, embed=response.embed, allowed_mentions=response.mentions)
+            else:
+                await msg.channel.send(response.content, allowed_mentions=response.mentions)
+
+        record_use(name, id)
 
     @cleanup
     @group("tag")
@@ -232,7 +501,7 @@ class Factoids(Cog):
                 return
 
             session.add(
-                Alias(
+                alias := Alias(
                     name=name,
                     author_id=ctx.author.id,
                     created_at=datetime.utcnow(),
@@ -247,6 +516,7 @@ class Factoids(Cog):
                 )
             )
             await session.commit()
+            add_alias(name, alias.id)
         await ctx.send(format("Factoid created, use with {!i}", prefix + name))
 
     @privileged
@@ -267,6 +537,7 @@ class Factoids(Cog):
 
             session.add(Alias(name=newname, author_id=ctx.author.id, created_at=datetime.utcnow(), uses=0, id=alias.id))
             await session.commit()
+            add_alias(newname, alias.id)
         await ctx.send(format("Aliased {!i} to {!i}", prefix + newname, prefix + name))
 
     @privileged
@@ -293,6 +564,7 @@ class Factoids(Cog):
             alias.factoid.embed_data = content.to_dict() if not isinstance(content, str) else None
             alias.factoid.author_id = ctx.author.id
             await session.commit()
+            invalidate_response(alias.id)
         await ctx.send(format("Factoid updated, use with {!i}", prefix + name))
 
     @privileged
@@ -312,6 +584,7 @@ class Factoids(Cog):
 
             await session.delete(alias)
             await session.commit()
+            remove_alias(name)
         await ctx.send(format("Alias removed"))
 
     @privileged
@@ -324,11 +597,14 @@ class Factoids(Cog):
             if (alias := await session.get(Alias, name)) is None:
                 raise UserError(format("The factoid {!i} does not exist", prefix + name))
 
-            stmt = delete(Alias).where(Alias.id == alias.id)
-            await session.execute(stmt)
+            stmt = delete(Alias).where(Alias.id == alias.id).returning(Alias.name)
+            names = (await session.execute(stmt)).scalars().all()
             stmt = delete(Factoid).where(Factoid.id == alias.id)
             await session.execute(stmt)
             await session.commit()
+            invalidate_response(alias.id)
+            for name in names:
+                remove_alias(name)
         await ctx.send(format("Factoid deleted"))
 
     @privileged
@@ -337,6 +613,7 @@ class Factoids(Cog):
         """Show information about a factoid."""
         assert prefix is not None
         name = validate_name(name)
+        await flush_uses()
         async with sessionmaker() as session:
             if (alias := await session.get(Alias, name)) is None:
                 raise UserError(format("The factoid {!i} does not exist", prefix + name))
@@ -364,6 +641,7 @@ class Factoids(Cog):
     @tag_command.command("top")
     async def tag_top(self, ctx: Context) -> None:
         """Show most used factoids."""
+        await flush_uses()
         async with sessionmaker() as session:
             aliases = aliased(Alias)
             stmt = (
@@ -385,6 +663,20 @@ class Factoids(Cog):
             results = list(await session.execute(stmt))
             await ctx.send("\n".join(format("{!i}: {} uses", prefix + name, uses) for name, uses in results))
 
+    @privileged
+    @tag_command.command("search")
+    async def tag_search(self, ctx: Context, *, words: str) -> None:
+        """Search for factoids by words in their names or contents."""
+        assert prefix is not None
+        async with sessionmaker() as session:
+            results = await search_factoids(session, words, SEARCH_LIMIT)
+        if not results:
+            raise UserError("No factoids found")
+        await ctx.send(
+            "\n".join(format("{!i}: {} uses", prefix + name, uses) for name, uses, _ in results),
+            allowed_mentions=AllowedMentions.none(),
+        )
+
     @privileged
     @tag_command.command("flags")
     async def tag_flags(self, ctx: Context, name: str, flags: Optional[Union[CodeBlock, Inline, Quoted]]) -> None:
@@ -404,9 +696,50 @@ class Factoids(Cog):
             else:
                 alias.factoid.flags = json.loads(flags.text)
                 await session.commit()
+                invalidate_response(alias.id)
                 await ctx.send("\u2705")
 
 
+@command("factoid", description="Show a factoid.")
+async def factoid_command(interaction: Interaction, name: str) -> None:
+    if use_tags.evaluate(*evaluate_interaction(interaction)) != EvalResult.TRUE:
+        await interaction.response.send_message("You cannot use factoids here", ephemeral=True)
+        return
+    name = " ".join(name.split()).lower()
+    if (id := alias_ids.get(name)) is None or (response := await get_response(id)) is None:
+        await interaction.response.send_message(format("The factoid {!i} does not exist", name), ephemeral=True)
+        return
+    if response.acl is not None and evaluate_acl(response.acl, *evaluate_interaction(interaction)) != EvalResult.TRUE:
+        await interaction.response.send_message("You cannot use this factoid here", ephemeral=True)
+        return
+
+    if response.embed is not None:
+        await interaction.response.send_message(
+            response.content, embed=response.embed, allowed_mentions=response.mentions
+        )
+    else:
+        await interaction.response.send_message(response.content, allowed_mentions=response.mentions)
+
+    record_use(name, id)
+
+
+@factoid_command.autocomplete("name")
+async def factoid_autocomplete(interaction: Interaction, input: str) -> List[Choice[str]]:
+    # Don't reveal factoids that the user cannot use
+    if use_tags.evaluate(*evaluate_interaction(interaction)) != EvalResult.TRUE:
+        return []
+    start = perf_counter()
+    async with sessionmaker() as session:
+        results = await search_factoids(session, input, AUTOCOMPLETE_LIMIT)
+    logger.debug("Autocomplete for {!r} took {:.3f}s".format(input, perf_counter() - start))
+    return [
+        Choice(name=name, value=name)
+        for name, _, acl in results
+        if len(name) <= 100
+        and (acl is None or evaluate_acl(acl, *evaluate_interaction(interaction)) == EvalResult.TRUE)
+    ]
+
+
 async def prompt_contents(ctx: Context) -> Optional[Union[str, Embed]]:
     prompt = await ctx.send("Please enter the factoid contents:")
     response = await get_input(prompt, ctx.author, {"\u274C": None}, timeout=300)
@@ -1,20 +1,36 @@
 from __future__ import annotations
 
 import asyncio
-from collections import defaultdict
-from datetime import datetime, timedelta
-from difflib import SequenceMatcher
-from io import BytesIO
-from itertools import zip_longest
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import gzip
+import hashlib
 import logging
 import os
 from pathlib import Path
-from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Protocol, Sequence, Set, cast
+import re
+from tempfile import TemporaryFile, mkstemp
+from time import perf_counter
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Protocol,
+    Sequence,
+    Set,
+    Tuple,
+    cast,
+)
+import zlib
 
-import discord
+import aiohttp
 from discord import (
     AllowedMentions,
-    Attachment,
     File,
     Guild,
     Member,
@@ -27,9 +43,22 @@ from discord import (
     User,
 )
 from discord.utils import time_snowflake
-from sqlalchemy import CHAR, TEXT, TIMESTAMP, BigInteger, ForeignKey, delete, select, update
-from sqlalchemy.dialects.postgresql import BYTEA
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy import (
+    CHAR,
+    INTEGER,
+    TEXT,
+    TIMESTAMP,
+    BigInteger,
+    CursorResult,
+    bindparam,
+    delete,
+    func,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects.postgresql import BYTEA, insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 import sqlalchemy.orm
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.schema import DDL, CreateSchema
@@ -53,6 +82,8 @@ class LoggerConf(Protocol):
     perm_channel: int
     keep: int
     file_path: str
+    compress: Optional[bool]
+    compress_reports: Optional[bool]
 
 
 conf: LoggerConf
@@ -65,7 +96,7 @@ sessionmaker = async_sessionmaker(util.db.engine, future=True, expire_on_commit=
 @registry.mapped
 class SavedMessage:
     __tablename__ = "messages"
-    __table_args__ = {"schema": "log"}
+    __table_args__ = {"schema": "log", "postgresql_partition_by": "RANGE (id)"}
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
     channel_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
@@ -84,10 +115,10 @@ class SavedMessage:
 @registry.mapped
 class SavedFile:
     __tablename__ = "files"
-    __table_args__ = {"schema": "log"}
+    __table_args__ = {"schema": "log", "postgresql_partition_by": "RANGE (id)"}
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
-    message_id: Mapped[int] = mapped_column(BigInteger, ForeignKey(SavedMessage.id), nullable=False)
+    message_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
     filename: Mapped[str] = mapped_column(TEXT, nullable=False)
     url: Mapped[str] = mapped_column(TEXT, nullable=False)
     local_filename: Mapped[Optional[str]] = mapped_column(TEXT)
@@ -135,84 +166,456 @@ class SavedNick:
         ) -> None: ...
 
 
-def path_for(attm: Attachment) -> Path:
-    return Path(conf.file_path, str(attm.id))
+@registry.mapped
+class CompressionDictionary:
+    __tablename__ = "dictionaries"
+    __table_args__ = {"schema": "log"}
+
+    id: Mapped[int] = mapped_column(INTEGER, primary_key=True)
+    data: Mapped[bytes] = mapped_column(BYTEA, nullable=False)
+
+    if TYPE_CHECKING:
+
+        def __init__(self, *, data: bytes, id: int = ...) -> None: ...
+
+
+# When compression is enabled, message content is stored as a raw deflate stream primed with a preset dictionary, which
+# is trained on previously stored messages, as most chat messages are too short to compress well on their own. A
+# compressed value starts with a 0xFF byte (which never occurs in UTF-8) followed by the 2-byte id of the dictionary,
+# where 0 means no dictionary. Any other value is plain UTF-8.
+COMPRESSED_TAG: bytes = b"\xff"
+# The size of the deflate window, anything further back can't be referenced
+DICTIONARY_SIZE: int = 1 << 15
+DICTIONARY_SAMPLES: int = 10000
+RECOMPRESS_BATCH: int = 1000
+RECOMPRESS_DELAY: float = 1.0
+
+dictionaries: Dict[int, bytes] = {}
+current_dictionary: int = 0
+
+dictionary_token_re: re.Pattern[bytes] = re.compile(rb"\s?\S+")
+
+
+def train_dictionary(samples: Iterable[bytes]) -> bytes:
+    counts: Counter[bytes] = Counter()
+    for sample in samples:
+        counts.update(set(dictionary_token_re.findall(sample)))
+    tokens = sorted((token for token, count in counts.items() if count > 1), key=lambda t: counts[t] * len(t))
+    # Matches are cheaper the closer they are to the end of the dictionary, so the most useful tokens go last
+    dictionary: List[bytes] = []
+    size = 0
+    for token in reversed(tokens):
+        if size + len(token) > DICTIONARY_SIZE:
+            break
+        dictionary.append(token)
+        size += len(token)
+    return b"".join(reversed(dictionary))
+
+
+def encode_content(content: str) -> bytes:
+    data = content.encode("utf8")
+    if not conf.compress:
+        return data
+    if current_dictionary:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=dictionaries[current_dictionary])
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    compressed = COMPRESSED_TAG + current_dictionary.to_bytes(2, "big") + compressor.compress(data) + compressor.flush()
+    return compressed if len(compressed) < len(data) else data
+
+
+def decode_content(data: bytes) -> str:
+    if data[:1] == COMPRESSED_TAG:
+        dictionary = int.from_bytes(data[1:3], "big")
+        if dictionary:
+            decompressor = zlib.decompressobj(-15, zdict=dictionaries[dictionary])
+        else:
+            decompressor = zlib.decompressobj(-15)
+        data = decompressor.decompress(data[3:]) + decompressor.flush()
+    return data.decode("utf8")
+
+
+async def load_dictionaries() -> None:
+    global current_dictionary
+    async with sessionmaker() as session:
+        stmt = select(CompressionDictionary)
+        for dictionary in (await session.execute(stmt)).scalars():
+            dictionaries[dictionary.id] = dictionary.data
+
+        if conf.compress and not dictionaries:
+            stmt = select(SavedMessage.content).order_by(SavedMessage.id.desc()).limit(DICTIONARY_SAMPLES)
+            samples = [decode_content(content).encode("utf8") for content in (await session.execute(stmt)).scalars()]
+            if data := train_dictionary(samples):
+                dictionary = CompressionDictionary(data=data)
+                session.add(dictionary)
+                await session.commit()
+                logger.info("Trained a {} byte dictionary on {} messages".format(len(data), len(samples)))
+                dictionaries[dictionary.id] = data
+
+    current_dictionary = max(dictionaries, default=0)
+
+
+async def recompress_messages() -> None:
+    """Compress the messages that were stored uncompressed, in batches."""
+    try:
+        last_id = -1
+        total = 0
+        while True:
+            async with sessionmaker() as session:
+                stmt = (
+                    select(SavedMessage.id, SavedMessage.content)
+                    .where(SavedMessage.id > last_id, func.substring(SavedMessage.content, 1, 1) != COMPRESSED_TAG)
+                    .order_by(SavedMessage.id)
+                    .limit(RECOMPRESS_BATCH)
+                )
+                rows = list(await session.execute(stmt))
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                params = [
+                    {"b_id": id, "b_old": content, "b_new": new_content}
+                    for id, content in rows
+                    if (new_content := encode_content(decode_content(content))) != content
+                ]
+                if params:
+                    # Don't overwrite messages that have been edited in the meantime
+                    stmt = (
+                        update(SavedMessage)
+                        .where(SavedMessage.id == bindparam("b_id"), SavedMessage.content == bindparam("b_old"))
+                        .values(content=bindparam("b_new"))
+                    )
+                    await (await session.connection()).execute(stmt, params)
+                    await session.commit()
+                    total += len(params)
+            await asyncio.sleep(RECOMPRESS_DELAY)
+        if total:
+            logger.info("Compressed {} stored messages".format(total))
+    except asyncio.CancelledError:
+        raise
+    except:
+        logger.error("Could not compress stored messages", exc_info=True)
+
+
+# Attachments are archived by a pool of workers separately from message ingestion. Each file is streamed to a temporary
+# location while being hashed, and then stored under its SHA-256, so that reposts of the same file share one copy. The
+# reference count of a stored file is the number of log.files rows whose local_filename points to it.
+http: aiohttp.ClientSession = aiohttp.ClientSession()
+plugins.finalizer(http.close)
+
+ARCHIVE_WORKERS: int = 4
+ARCHIVE_CHUNK_SIZE: int = 1 << 16
+ARCHIVE_TIMEOUT: aiohttp.ClientTimeout = aiohttp.ClientTimeout(total=600, sock_read=60)
+
+# Attachments left unarchived by a previous run are retried on load if they are at most this old, older attachment URLs
+# have most likely expired
+ARCHIVE_RETRY_AGE: timedelta = timedelta(days=1)
+
+# Attachment id and the URLs to try downloading it from
+archive_queue: asyncio.Queue[Tuple[int, List[str]]] = asyncio.Queue()
+# Ids of the attachments that are queued or being archived, so that an attachment is not downloaded twice at once
+archive_pending: Set[int] = set()
+# Held while a stored file is being added or removed, so that we don't delete a file that is just gaining a reference
+archive_lock: asyncio.Lock = asyncio.Lock()
+
+
+def path_for_digest(digest: str) -> Path:
+    return Path(conf.file_path, digest[:2], digest)
 
 
-async def save_attachment(attm: Attachment) -> None:
-    path = path_for(attm)
-    path.parent.mkdir(parents=True, exist_ok=True)
+def tmp_dir() -> Path:
+    return Path(conf.file_path, "tmp")
+
+
+def clear_tmp_files() -> None:
+    """Delete the partial downloads left over by a previous run."""
+    try:
+        for path in tmp_dir().iterdir():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+    except FileNotFoundError:
+        pass
+
+
+def queue_attachment(id: int, urls: List[str]) -> bool:
+    """Queue an attachment for archiving, unless it is already queued or being archived."""
+    if id in archive_pending:
+        return False
+    archive_pending.add(id)
+    archive_queue.put_nowait((id, urls))
+    return True
+
+
+async def download(url: str, path: Path) -> str:
+    hasher = hashlib.sha256()
+    async with http.get(url, timeout=ARCHIVE_TIMEOUT) as response:
+        response.raise_for_status()
+        with open(path, "wb") as f:
+            async for chunk in response.content.iter_chunked(ARCHIVE_CHUNK_SIZE):
+                hasher.update(chunk)
+                f.write(chunk)
+    return hasher.hexdigest()
+
+
+async def release_files(session: AsyncSession, filepaths: Set[str]) -> None:
+    """Delete those of the given stored files that are no longer referenced. Call with archive_lock held."""
+    if not filepaths:
+        return
+    stmt = select(SavedFile.local_filename).where(SavedFile.local_filename.in_(filepaths)).distinct()
+    for filepath in filepaths - set((await session.execute(stmt)).scalars()):
+        try:
+            os.unlink(filepath)
+        except FileNotFoundError:
+            pass
+
+
+async def archive_attachment(id: int, urls: List[str]) -> None:
+    tmp_dir().mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = mkstemp(dir=tmp_dir(), prefix="{}-".format(id))
+    os.close(fd)
+    tmp_path = Path(tmp_name)
     try:
-        await attm.save(path, use_cached=True)
-    except discord.HTTPException:
-        await attm.save(path)
+        digest = None
+        for url in urls:
+            try:
+                digest = await download(url, tmp_path)
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if url == urls[-1]:
+                    raise
+        assert digest is not None
+        path = path_for_digest(digest)
+        async with archive_lock:
+            if path.exists():
+                os.unlink(tmp_path)
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp_path, path)
+            async with sessionmaker() as session:
+                stmt = update(SavedFile).where(SavedFile.id == id).values(local_filename=str(path))
+                if cast(CursorResult[Any], await session.execute(stmt)).rowcount == 0:
+                    # The message has been cleaned up in the meantime
+                    await release_files(session, {str(path)})
+                await session.commit()
+    finally:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+async def archive_worker() -> None:
+    while True:
+        id, urls = await archive_queue.get()
+        try:
+            await archive_attachment(id, urls)
+        except asyncio.CancelledError:
+            raise
+        except:
+            logger.info("Could not save attachment {}".format(id), exc_info=True)
+        finally:
+            archive_pending.discard(id)
+
+
+async def requeue_attachments() -> None:
+    """Queue the attachments that were saved but not archived before the plugin was last unloaded."""
+    cutoff = time_snowflake(datetime.now(timezone.utc) - ARCHIVE_RETRY_AGE)
+    async with sessionmaker() as session:
+        stmt = select(SavedFile.id, SavedFile.url).where(SavedFile.local_filename == None, SavedFile.id >= cutoff)
+        requeued = 0
+        for id, url in await session.execute(stmt):
+            if queue_attachment(id, [url]):
+                requeued += 1
+        stmt = select(func.count(SavedFile.id)).where(SavedFile.local_filename == None, SavedFile.id < cutoff)
+        expired = (await session.execute(stmt)).scalar()
+    if requeued:
+        logger.info("Queued {} attachments left unarchived".format(requeued))
+    if expired:
+        logger.info("Not archiving {} attachments older than {}".format(expired, ARCHIVE_RETRY_AGE))
+
+
+# Rows per INSERT statement, keeping well under the limit of 32767 query parameters
+INSERT_BATCH: int = 1000
 
 
 async def register_messages(msgs: Iterable[Message]) -> None:
+    start = perf_counter()
+    messages: Dict[int, Dict[str, object]] = {}
+    files: Dict[int, Dict[str, object]] = {}
+    urls: Dict[int, List[str]] = {}
+    for msg in msgs:
+        if not msg.author.bot:
+            messages[msg.id] = {
+                "id": msg.id,
+                "channel_id": msg.channel.id,
+                "author_id": msg.author.id,
+                "username": msg.author.name + "#" + msg.author.discriminator,
+                "nick": msg.author.nick if isinstance(msg.author, Member) else None,
+                "content": encode_content(msg.content),
+            }
+            for attm in msg.attachments:
+                files[attm.id] = {"id": attm.id, "message_id": msg.id, "filename": attm.filename, "url": attm.url}
+                urls[attm.id] = [attm.proxy_url, attm.url]
+    if not messages:
+        return
+
     async with sessionmaker() as session:
-        filepaths = set()
-        try:
-            for msg in msgs:
-                if not msg.author.bot:
-                    await session.merge(
-                        SavedMessage(
-                            id=msg.id,
-                            channel_id=msg.channel.id,
-                            author_id=msg.author.id,
-                            username=msg.author.name + "#" + msg.author.discriminator,
-                            nick=msg.author.nick if isinstance(msg.author, Member) else None,
-                            content=msg.content.encode("utf8"),
-                        )
-                    )
-                    filepaths |= {path_for(attm) for attm in msg.attachments}
-                    attm_data = await asyncio.gather(
-                        *[save_attachment(attm) for attm in msg.attachments], return_exceptions=True
-                    )
-                    await session.flush()
-                    for attm, exc in zip(msg.attachments, attm_data):
-                        if exc is not None:
-                            logger.info(
-                                "Could not save attachment {} for {}".format(attm.proxy_url, msg.id), exc_info=exc
-                            )
-                            try:
-                                os.unlink(path_for(attm))
-                            except FileNotFoundError:
-                                pass
-                        await session.merge(
-                            SavedFile(
-                                id=attm.id,
-                                message_id=msg.id,
-                                filename=attm.filename,
-                                url=attm.url,
-                                local_filename=str(path_for(attm)) if exc is None else None,
-                            )
-                        )
+        message_rows = list(messages.values())
+        for i in range(0, len(message_rows), INSERT_BATCH):
+            stmt = insert(SavedMessage).values(message_rows[i : i + INSERT_BATCH])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[SavedMessage.id],
+                set_={
+                    "channel_id": stmt.excluded.channel_id,
+                    "author_id": stmt.excluded.author_id,
+                    "username": stmt.excluded.username,
+                    "nick": stmt.excluded.nick,
+                    "content": stmt.excluded.content,
+                },
+            )
+            await session.execute(stmt)
+        archive: List[int] = []
+        file_rows = list(files.values())
+        for i in range(0, len(file_rows), INSERT_BATCH):
+            stmt = insert(SavedFile).values(file_rows[i : i + INSERT_BATCH])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[SavedFile.id],
+                set_={
+                    "message_id": stmt.excluded.message_id,
+                    "filename": stmt.excluded.filename,
+                    "url": stmt.excluded.url,
+                },
+            ).returning(SavedFile.id, SavedFile.local_filename)
+            archive.extend(id for id, local_filename in await session.execute(stmt) if local_filename is None)
+        await session.commit()
+
+    for id in archive:
+        queue_attachment(id, urls[id])
+
+    elapsed = perf_counter() - start
+    logger.debug(
+        "Registered {} messages and {} files in {:.3f}s ({:.0f} messages/s)".format(
+            len(messages), len(files), elapsed, len(messages) / elapsed if elapsed > 0 else float("inf")
+        )
+    )
+
+
+# log.messages and log.files are partitioned by ranges of snowflake ids, one partition per UTC day, so that expired rows
+# can be dropped a partition at a time instead of being deleted row by row. Partitions are created a few days ahead of
+# time. Rows that don't fall into a daily partition (e.g. old messages fetched retroactively) go to the default
+# partition, and the rows of a partition that has only partially expired are deleted in batches.
+PARTITIONED_TABLES: Sequence[str] = ("messages", "files")
+PARTITION_DAYS_AHEAD: int = 7
+# Rows deleted per transaction from partitions that have only partially expired
+CLEANUP_BATCH: int = 10000
+
+partition_bound_re: re.Pattern[str] = re.compile(r"FOR VALUES FROM \((.*)\) TO \((.*)\)")
+
+
+def parse_partition_bound(bound: str) -> int:
+    bound = bound.strip("'")
+    if bound == "MINVALUE":
+        return -(1 << 63)
+    elif bound == "MAXVALUE":
+        return 1 << 63
+    else:
+        return int(bound)
+
+
+async def get_partitions(session: AsyncSession, table: str) -> List[Tuple[str, int, int]]:
+    """List the range partitions of the given table, with their lower (inclusive) and upper (exclusive) bounds."""
+    stmt = text(
+        """
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            JOIN pg_namespace n ON n.oid = p.relnamespace
+        WHERE n.nspname = 'log' AND p.relname = :table
+        """
+    )
+    partitions = []
+    for name, bound in await session.execute(stmt, {"table": table}):
+        if (match := partition_bound_re.match(bound)) is not None:
+            partitions.append((name, parse_partition_bound(match[1]), parse_partition_bound(match[2])))
+    return partitions
+
+
+async def create_partitions(session: AsyncSession, table: str) -> None:
+    now = datetime.now(timezone.utc)
+    today = datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
+    partitions = await get_partitions(session, table)
+    for i in range(PARTITION_DAYS_AHEAD + 1):
+        start = today + timedelta(days=i)
+        lower, upper = time_snowflake(start), time_snowflake(start + timedelta(days=1))
+        if any(lower < part_upper and part_lower < upper for _, part_lower, part_upper in partitions):
+            continue
+        name = "{}_p{}".format(table, start.strftime("%Y%m%d"))
+        logger.debug("Creating partition log.{}".format(name))
+        await session.execute(
+            text(
+                "CREATE TABLE log.{} PARTITION OF log.{} FOR VALUES FROM ({}) TO ({})".format(name, table, lower, upper)
+            )
+        )
+        partitions.append((name, lower, upper))
+
+
+async def drop_partitions(table: str, cutoff: int) -> None:
+    """
+    Drop the partitions of the given table that only contain ids below the cutoff. Detaching a partition locks the whole
+    table, so each partition is dropped in its own transaction, committed right away.
+    """
+    async with sessionmaker() as session:
+        partitions = await get_partitions(session, table)
+    for name, _, upper in partitions:
+        if upper > cutoff:
+            continue
+        logger.debug("Dropping partition log.{}".format(name))
+        async with sessionmaker() as session:
+            filepaths: Set[str] = set()
+            if table == SavedFile.__tablename__:
+                stmt = text("SELECT DISTINCT local_filename FROM log.{} WHERE local_filename IS NOT NULL".format(name))
+                filepaths = set((await session.execute(stmt)).scalars())
+            await session.execute(text("ALTER TABLE log.{} DETACH PARTITION log.{}".format(table, name)))
+            await session.execute(text("DROP TABLE log.{}".format(name)))
             await session.commit()
-            filepaths = set()
-        finally:
-            for filepath in filepaths:
-                try:
-                    os.unlink(filepath)
-                except FileNotFoundError:
-                    pass
+
+            async with archive_lock:
+                await release_files(session, filepaths)
 
 
 @task(name="Log cleanup task", every=3600)
 async def clean_old_messages() -> None:
     cutoff_time = datetime.utcnow() - timedelta(seconds=conf.keep)
-    cutoff = time_snowflake(cutoff_time)
-    async with sessionmaker() as session:
-        stmt = delete(SavedFile).where(SavedFile.id < cutoff).returning(SavedFile.local_filename)
-        for filepath in (await session.execute(stmt)).scalars():
-            if filepath is not None:
-                try:
-                    os.unlink(filepath)
-                except FileNotFoundError:
-                    pass
-
-        stmt = delete(SavedMessage).where(SavedMessage.id < cutoff)
-        await session.execute(stmt)
+    cutoff = time_snowflake(cutoff_time.replace(tzinfo=timezone.utc))
+
+    for table in PARTITIONED_TABLES:
+        await drop_partitions(table, cutoff)
+
+    # Delete the remaining expired rows in short transactions, so as not to block ingestion for long
+    while True:
+        async with sessionmaker() as session:
+            ids = select(SavedFile.id).where(SavedFile.id < cutoff).limit(CLEANUP_BATCH).scalar_subquery()
+            stmt = delete(SavedFile).where(SavedFile.id.in_(ids)).returning(SavedFile.local_filename)
+            filepaths = list((await session.execute(stmt)).scalars())
+            await session.commit()
+
+            async with archive_lock:
+                await release_files(session, set(filepath for filepath in filepaths if filepath is not None))
+        if len(filepaths) < CLEANUP_BATCH:
+            break
+
+    while True:
+        async with sessionmaker() as session:
+            ids = select(SavedMessage.id).where(SavedMessage.id < cutoff).limit(CLEANUP_BATCH).scalar_subquery()
+            stmt = delete(SavedMessage).where(SavedMessage.id.in_(ids))
+            deleted = cast(CursorResult[Any], await session.execute(stmt)).rowcount
+            await session.commit()
+        if deleted < CLEANUP_BATCH:
+            break
 
+    async with sessionmaker() as session:
         stmt = delete(SavedUser).where(SavedUser.unset_at < cutoff_time)
         await session.execute(stmt)
 
@@ -220,6 +623,12 @@ async def clean_old_messages() -> None:
         await session.execute(stmt)
 
         await session.commit()
+
+    for table in PARTITIONED_TABLES:
+        async with sessionmaker() as session:
+            await create_partitions(session, table)
+            await session.commit()
+
     # Clearing logs_edited and logs_deleted
     if isinstance(channel := client.get_channel(conf.temp_channel_edited), TextChannel):
         await channel.purge(before=Object(cutoff), limit=None)
@@ -236,12 +645,29 @@ async def init() -> None:
             registry.metadata.create_all,
             DDL(
                 """
+        CREATE TABLE log.messages_default PARTITION OF log.messages DEFAULT;
+        CREATE TABLE log.files_default PARTITION OF log.files DEFAULT;
         CREATE INDEX messages_author_id ON log.messages USING BTREE (author_id);
+        CREATE INDEX files_local_filename ON log.files USING BTREE (local_filename);
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX users_name_trgm ON log.users USING GIN (LOWER(username || '#' || discrim) gin_trgm_ops);
+        CREATE INDEX nicks_nick_trgm ON log.nicks USING GIN (LOWER(nick) gin_trgm_ops);
         """
             ),
         )
     )
     conf = cast(LoggerConf, await util.db.kv.load(__name__))
+    async with sessionmaker() as session:
+        for table in PARTITIONED_TABLES:
+            await create_partitions(session, table)
+        await session.commit()
+    await load_dictionaries()
+    if conf.compress:
+        plugins.finalizer(asyncio.create_task(recompress_messages(), name="Log recompression").cancel)
+    await asyncio.get_event_loop().run_in_executor(None, clear_tmp_files)
+    for i in range(ARCHIVE_WORKERS):
+        plugins.finalizer(asyncio.create_task(archive_worker(), name="Attachment archiver {}".format(i)).cancel)
+    await requeue_attachments()
     await bot.message_tracker.subscribe(__name__, None, register_messages, missing=True, retroactive=False)
 
     async def unsubscribe() -> None:
@@ -250,16 +676,150 @@ async def init() -> None:
     plugins.finalizer(unsubscribe)
 
 
+# Edits are diffed word by word using Myers' algorithm, after trimming the common prefix and suffix. Diffs that would be
+# too large or take too long to compute are rendered as the whole message being replaced instead.
+DIFF_MAX_TOKENS: int = 4000
+DIFF_MAX_EDITS: int = 300
+DIFF_TIME_BUDGET: float = 0.02
+
+diff_token_re: re.Pattern[str] = re.compile(r"\w+|\s+|[^\w\s]")
+
+
+def diff_tokens(old: Sequence[str], new: Sequence[str], deadline: float) -> Optional[List[Tuple[str, str, str]]]:
+    """
+    Compute a shortest edit script between two sequences of tokens, as a list of (tag, old, new) segments with tag being
+    one of "equal", "replace", "delete", "insert". Return None if the number of edits or the time exceeds the budget.
+    """
+    n, m = len(old), len(new)
+    v = {1: 0}
+    trace: List[Dict[int, int]] = []
+    done = False
+    for d in range(DIFF_MAX_EDITS + 1):
+        if perf_counter() > deadline:
+            return None
+        trace.append(v.copy())
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and old[x] == new[y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                done = True
+                break
+        if done:
+            break
+    if not done:
+        return None
+
+    # Walk back through the trace, collecting single-token operations in reverse
+    ops: List[Tuple[str, str]] = []
+    x, y = n, m
+    for d in reversed(range(len(trace))):
+        v = trace[d]
+        k = x - y
+        prev_k = k + 1 if k == -d or (k != d and v[k - 1] < v[k + 1]) else k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            ops.append(("=", old[x]))
+        if d > 0:
+            if x == prev_x:
+                ops.append(("+", new[prev_y]))
+            else:
+                ops.append(("-", old[prev_x]))
+        x, y = prev_x, prev_y
+    ops.reverse()
+
+    segments: List[Tuple[str, str, str]] = []
+    i = 0
+    while i < len(ops):
+        j = i
+        if ops[i][0] == "=":
+            while j < len(ops) and ops[j][0] == "=":
+                j += 1
+            text = "".join(token for _, token in ops[i:j])
+            segments.append(("equal", text, text))
+        else:
+            while j < len(ops) and ops[j][0] != "=":
+                j += 1
+            deleted = "".join(token for op, token in ops[i:j] if op == "-")
+            inserted = "".join(token for op, token in ops[i:j] if op == "+")
+            segments.append(
+                ("replace" if deleted and inserted else "delete" if deleted else "insert", deleted, inserted)
+            )
+        i = j
+    return segments
+
+
+def merge_diff_segments(segments: List[Tuple[str, str, str]]) -> List[Tuple[str, str, str]]:
+    """Absorb whitespace between two changes into them, so that runs of replaced words read as one replacement."""
+    result: List[Tuple[str, str, str]] = []
+    for segment in segments:
+        if (
+            segment[0] != "equal"
+            and len(result) >= 2
+            and result[-1][0] == "equal"
+            and result[-1][1].isspace()
+            and result[-2][0] != "equal"
+        ):
+            _, space, _ = result.pop()
+            _, deleted, inserted = result.pop()
+            deleted += space + segment[1]
+            inserted += space + segment[2]
+            segment = ("replace", deleted, inserted)
+        result.append(segment)
+    return result
+
+
+def word_diff(old: str, new: str) -> Optional[List[Tuple[str, str, str]]]:
+    deadline = perf_counter() + DIFF_TIME_BUDGET
+    old_tokens = diff_token_re.findall(old)
+    new_tokens = diff_token_re.findall(new)
+    prefix = 0
+    while prefix < min(len(old_tokens), len(new_tokens)) and old_tokens[prefix] == new_tokens[prefix]:
+        prefix += 1
+    suffix = 0
+    while (
+        suffix < min(len(old_tokens), len(new_tokens)) - prefix
+        and old_tokens[len(old_tokens) - suffix - 1] == new_tokens[len(new_tokens) - suffix - 1]
+    ):
+        suffix += 1
+    old_middle = old_tokens[prefix : len(old_tokens) - suffix]
+    new_middle = new_tokens[prefix : len(new_tokens) - suffix]
+    if len(old_middle) + len(new_middle) > DIFF_MAX_TOKENS:
+        return None
+    if (segments := diff_tokens(old_middle, new_middle, deadline)) is None:
+        return None
+
+    head = "".join(old_tokens[:prefix])
+    tail = "".join(old_tokens[len(old_tokens) - suffix :])
+    return (
+        ([("equal", head, head)] if head else [])
+        + merge_diff_segments(segments)
+        + ([("equal", tail, tail)] if tail else [])
+    )
+
+
 def format_word_diff(old: str, new: str) -> Iterator[PlainItem]:
-    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old, new).get_opcodes():
+    if (segments := word_diff(old, new)) is None:
+        yield PlainItem(format("~~{!i}~~**{!i}**", old, new))
+        return
+    for tag, old_text, new_text in segments:
         if tag == "replace":
-            yield PlainItem(format("~~{!i}~~**{!i}**", old[i1:i2], new[j1:j2]))
+            yield PlainItem(format("~~{!i}~~**{!i}**", old_text, new_text))
         elif tag == "delete":
-            yield PlainItem(format("~~{!i}~~", old[i1:i2]))
+            yield PlainItem(format("~~{!i}~~", old_text))
         elif tag == "insert":
-            yield PlainItem(format("**{!i}**", new[j1:j2]))
+            yield PlainItem(format("**{!i}**", new_text))
         elif tag == "equal":
-            yield PlainItem(format("{!i}", new[j1:j2]))
+            yield PlainItem(format("{!i}", new_text))
 
 
 def user_nick(user: str, nick: Optional[str]) -> str:
@@ -272,9 +832,9 @@ def user_nick(user: str, nick: Optional[str]) -> str:
 async def process_message_edit(update: RawMessageUpdateEvent) -> None:
     async with sessionmaker() as session:
         if (msg := await session.get(SavedMessage, update.message_id)) is not None:
-            old_content = msg.content.decode("utf8")
+            old_content = decode_content(msg.content)
             if "content" in update.data and (new_content := update.data["content"]) != old_content:
-                msg.content = new_content.encode("utf8")
+                msg.content = encode_content(new_content)
                 await session.commit()
                 for content, _ in chunk_messages(
                     [
@@ -312,7 +872,7 @@ async def process_message_delete(delete: RawMessageDeleteEvent) -> None:
                             user_nick(msg.username, msg.nick),
                         )
                     ),
-                    PlainItem(format("{!i}", msg.content.decode("utf8"))),
+                    PlainItem(format("{!i}", decode_content(msg.content))),
                 ]
                 + [PlainItem("\n**Attachment: <{}>**".format(url)) for url in file_urls]
             ):
@@ -321,34 +881,111 @@ async def process_message_delete(delete: RawMessageDeleteEvent) -> None:
                 )
 
 
+# Bulk delete reports are written to temporary files as the messages are read, and split into several attachments if
+# they don't fit in one. The upload limit applies to all attachments of a message together, so the parts are grouped
+# into messages that stay under it. The margin accounts for data buffered in the gzip compressor.
+REPORT_MARGIN: int = 1 << 20
+DEFAULT_UPLOAD_LIMIT: int = 8 << 20
+MAX_ATTACHMENTS: int = 10
+REPORT_BATCH: int = 1000
+
+
+class ReportWriter:
+    def __init__(self, limit: int, compress: bool) -> None:
+        self.limit = max(limit - REPORT_MARGIN, limit // 2)
+        self.compress = compress
+        self.files: List[IO[bytes]] = []
+        self.stream: Optional[IO[bytes]] = None
+
+    def start_file(self) -> None:
+        if self.stream is not None and self.stream is not self.files[-1]:
+            self.stream.close()
+        fp = TemporaryFile()
+        self.files.append(fp)
+        self.stream = cast(IO[bytes], gzip.GzipFile(fileobj=fp, mode="wb")) if self.compress else fp
+
+    def write(self, line: str) -> None:
+        data = (line + "\n").encode("utf8")
+        if not self.files or self.files[-1].tell() > 0 and self.files[-1].tell() + len(data) > self.limit:
+            self.start_file()
+        assert self.stream is not None
+        self.stream.write(data)
+
+    def finish(self) -> List[List[File]]:
+        """Return the parts of the report, grouped into messages."""
+        if not self.files:
+            self.start_file()
+        if self.stream is not None and self.stream is not self.files[-1]:
+            self.stream.close()
+        self.stream = None
+        ext = ".txt.gz" if self.compress else ".txt"
+        result: List[List[File]] = []
+        total = 0
+        for i, fp in enumerate(self.files):
+            size = fp.seek(0, os.SEEK_END)
+            fp.seek(0)
+            filename = "log" + ext if len(self.files) == 1 else "log-{}{}".format(i + 1, ext)
+            if not result or len(result[-1]) >= MAX_ATTACHMENTS or total + size > self.limit:
+                result.append([])
+                total = 0
+            result[-1].append(File(cast(Any, fp), filename=filename))
+            total += size
+        return result
+
+    def close(self) -> None:
+        for fp in self.files:
+            fp.close()
+
+
 async def process_message_bulk_delete(deletes: RawBulkMessageDeleteEvent) -> None:
     deleted_ids = list(deletes.message_ids)
-    async with sessionmaker() as session:
-        attms: Dict[int, List[str]] = {}
-        stmt = select(SavedFile.message_id, SavedFile.url).where(SavedFile.message_id.in_(deleted_ids))
-        for message_id, url in await session.execute(stmt):
-            if message_id not in attms:
-                attms[message_id] = []
-            attms[message_id].append(url)
-
-        users: Set[int] = set()
-        log = []
-        stmt = select(SavedMessage).where(SavedMessage.id.in_(deleted_ids)).order_by(SavedMessage.id)
-        for msg in (await session.execute(stmt)).scalars():
-            users.add(msg.author_id)
-            log.append("{} {}: {}".format(msg.author_id, user_nick(msg.username, msg.nick), msg.content.decode("utf8")))
-            if msg.id in attms:
-                log.append("Attachments: {}".format(", ".join(attms[msg.id])))
+    channel = client.get_channel(conf.perm_channel)
+    limit = channel.guild.filesize_limit if isinstance(channel, TextChannel) else DEFAULT_UPLOAD_LIMIT
+    writer = ReportWriter(limit, bool(conf.compress_reports))
+    try:
+        async with sessionmaker() as session:
+            attms: Dict[int, List[str]] = {}
+            stmt = select(SavedFile.message_id, SavedFile.url).where(SavedFile.message_id.in_(deleted_ids))
+            for message_id, url in await session.execute(stmt):
+                if message_id not in attms:
+                    attms[message_id] = []
+                attms[message_id].append(url)
+
+            users: Set[int] = set()
+            stmt = (
+                select(
+                    SavedMessage.id,
+                    SavedMessage.author_id,
+                    SavedMessage.username,
+                    SavedMessage.nick,
+                    SavedMessage.content,
+                )
+                .where(SavedMessage.id.in_(deleted_ids))
+                .order_by(SavedMessage.id)
+                .execution_options(yield_per=REPORT_BATCH)
+            )
+            async for id, author_id, username, nick, content in await session.stream(stmt):
+                users.add(author_id)
+                writer.write("{} {}: {}".format(author_id, user_nick(username, nick), decode_content(content)))
+                if id in attms:
+                    writer.write("Attachments: {}".format(", ".join(attms[id])))
 
-        await client.get_partial_messageable(conf.perm_channel).send(
-            format(
-                "**Message bulk delete**: {!c} {}",
-                deletes.channel_id,
-                ", ".join(format("{!m}", user) for user in users),
-            ),
-            file=File(BytesIO("\n".join(log).encode("utf8")), filename="log.txt"),
-            allowed_mentions=AllowedMentions.none(),
-        )
+        for i, files in enumerate(writer.finish()):
+            await client.get_partial_messageable(conf.perm_channel).send(
+                (
+                    format(
+                        "**Message bulk delete**: {!c} {}",
+                        deletes.channel_id,
+                        ", ".join(format("{!m}", user) for user in users),
+                    )
+                    if i == 0
+                    else None
+                ),
+                files=files,
+                allowed_mentions=AllowedMentions.none(),
+            )
+    finally:
+        writer.close()
 
 
 async def process_user_change(id: int, before_name: str, before_discr: str, after_name: str, after_discr: str) -> None:
@@ -421,35 +1058,73 @@ async def sync_single_name(id: int, username: str, discrim: str, nick: Optional[
 
 
 async def sync_names(members: Sequence[Member]) -> None:
+    start = perf_counter()
     now = datetime.utcnow()
-    async with sessionmaker() as session:
-        for chunk in zip_longest(*([iter(members)] * 1024)):
-            member_ids = [member.id for member in chunk if member]
-
-            user_map = defaultdict(list)
-            stmt = select(SavedUser).where(SavedUser.unset_at == None, SavedUser.id.in_(member_ids))
-            for user in (await session.execute(stmt)).scalars():
-                user_map[user.id].append(user)
-            nick_map = defaultdict(list)
-            stmt = select(SavedNick).where(SavedNick.unset_at == None, SavedNick.id.in_(member_ids))
-            for nick in (await session.execute(stmt)).scalars():
-                nick_map[nick.id].append(nick)
-
-            for member in chunk:
-                if member:
-                    users = user_map[member.id]
-                    if len(users) != 1 or users[0].username != member.name or users[0].discrim != member.discriminator:
-                        for user in users:
-                            user.unset_at = now
-                        session.add(
-                            SavedUser(id=member.id, set_at=now, username=member.name, discrim=member.discriminator)
-                        )
-                    nicks = nick_map[member.id]
-                    if len(nicks) != 1 or nicks[0].nick != member.nick:
-                        for nick in nicks:
-                            nick.unset_at = now
-                        session.add(SavedNick(id=member.id, set_at=now, nick=member.nick))
-            await session.commit()
+    async with util.db.connection() as conn, conn.transaction():
+        await conn.execute(
+            """
+            CREATE TEMPORARY TABLE member_names (
+                id BIGINT PRIMARY KEY,
+                username TEXT NOT NULL,
+                discrim CHAR(4) NOT NULL,
+                nick TEXT
+            ) ON COMMIT DROP
+            """
+        )
+        await conn.copy_records_to_table(
+            "member_names",
+            records=[(member.id, member.name, member.discriminator, member.nick) for member in members],
+            columns=["id", "username", "discrim", "nick"],
+        )
+        await conn.execute("ANALYZE member_names")
+
+        users_unset = await conn.execute(
+            """
+            UPDATE log.users u
+            SET unset_at = $1
+            FROM member_names m
+            WHERE u.id = m.id AND u.unset_at IS NULL AND (u.username, u.discrim) IS DISTINCT FROM (m.username, m.discrim)
+            """,
+            now,
+        )
+        users_set = await conn.execute(
+            """
+            INSERT INTO log.users (id, set_at, username, discrim)
+            SELECT m.id, $1::TIMESTAMP, m.username, m.discrim
+            FROM member_names m
+            WHERE NOT EXISTS (SELECT FROM log.users u WHERE u.id = m.id AND u.unset_at IS NULL)
+            """,
+            now,
+        )
+        nicks_unset = await conn.execute(
+            """
+            UPDATE log.nicks n
+            SET unset_at = $1
+            FROM member_names m
+            WHERE n.id = m.id AND n.unset_at IS NULL AND n.nick IS DISTINCT FROM m.nick
+            """,
+            now,
+        )
+        nicks_set = await conn.execute(
+            """
+            INSERT INTO log.nicks (id, set_at, nick)
+            SELECT m.id, $1::TIMESTAMP, m.nick
+            FROM member_names m
+            WHERE NOT EXISTS (SELECT FROM log.nicks n WHERE n.id = m.id AND n.unset_at IS NULL)
+            """,
+            now,
+        )
+
+    logger.info(
+        "Synced names of {} members in {:.3f}s: {}/{} usernames and {}/{} nicks unset/set".format(
+            len(members),
+            perf_counter() - start,
+            users_unset.split()[-1],
+            users_set.split()[-1],
+            nicks_unset.split()[-1],
+            nicks_set.split()[-1],
+        )
+    )
 
 
 @cog
@@ -1,12 +1,20 @@
+from __future__ import annotations
+
+from array import array
 import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import accumulate
 import json
 import logging
 import re
-from typing import TYPE_CHECKING, Iterable, List, Optional, Set, Union, cast
+import time
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union, cast
 
 import aiohttp
 from discord.ext.commands import group
-from sqlalchemy import TEXT, BigInteger, Computed, delete, select
+from sqlalchemy import TEXT, TIMESTAMP, BigInteger, Computed, delete, select
+from sqlalchemy.dialects.postgresql import BYTEA
 from sqlalchemy.ext.asyncio import async_sessionmaker
 import sqlalchemy.orm
 from sqlalchemy.orm import Mapped, mapped_column
@@ -86,10 +94,155 @@ class AllowedDomain:
         def __init__(self, domain: str) -> None: ...
 
 
+@registry.mapped
+class Snapshot:
+    __tablename__ = "snapshot"
+    __table_args__ = {"schema": "phish"}
+
+    id: Mapped[int] = mapped_column(BigInteger, Computed("0"), primary_key=True)
+    domains: Mapped[bytes] = mapped_column(BYTEA, nullable=False)  # As returned by DomainIndex.dump
+    updated_at: Mapped[datetime] = mapped_column(TIMESTAMP, nullable=False)  # Time of the last change applied to it
+
+    if TYPE_CHECKING:
+
+        def __init__(self, *, domains: bytes, updated_at: datetime, id: int = ...) -> None: ...
+
+
+def normalize_domain(domain: str) -> str:
+    return domain.lower().strip(".").removeprefix("www.")
+
+
+def domain_suffixes(domain: str) -> List[str]:
+    """The domain itself and all its parent domains, most specific first."""
+    labels = normalize_domain(domain).split(".")
+    return [".".join(labels[i:]) for i in range(len(labels))]
+
+
+def reverse_domain(domain: str) -> bytes:
+    return ".".join(reversed(domain.split("."))).encode("utf")
+
+
+class DomainIndex:
+    """
+    A set of domains that also matches all subdomains of its members. The domains are stored with their labels reversed
+    (so that "login.example.com" becomes "com.example.login"), sorted, and packed into a single bytes object with an
+    array of offsets, which takes a fraction of the memory of a set of strings. Looking up a domain is a binary search
+    per label. Changes are recorded in small overlay sets, and are merged into the packed data once there are enough.
+    """
+
+    __slots__ = "data", "offsets", "added", "removed"
+    data: bytes
+    offsets: array[int]
+    added: Set[bytes]
+    removed: Set[bytes]
+
+    MERGE_THRESHOLD: int = 4096
+
+    def __init__(self, domains: Iterable[str] = ()) -> None:
+        self.added = set()
+        self.removed = set()
+        self.pack({reverse_domain(normalize_domain(domain)) for domain in domains})
+
+    @staticmethod
+    def load(data: bytes) -> DomainIndex:
+        index = DomainIndex()
+        if data:
+            index.pack(data.split(b"\n"))
+        return index
+
+    def dump(self) -> bytes:
+        self.merge()
+        return b"\n".join(self.packed_keys())
+
+    def pack(self, keys: Iterable[bytes]) -> None:
+        sorted_keys = sorted(keys)
+        self.data = b"".join(sorted_keys)
+        self.offsets = array("I", accumulate((len(key) for key in sorted_keys), initial=0))
+
+    def packed_keys(self) -> Iterator[bytes]:
+        for i in range(len(self.offsets) - 1):
+            yield self.data[self.offsets[i] : self.offsets[i + 1]]
+
+    def merge(self) -> None:
+        keys = set(self.packed_keys())
+        keys -= self.removed
+        keys |= self.added
+        self.pack(keys)
+        self.added.clear()
+        self.removed.clear()
+
+    def find_packed(self, key: bytes) -> bool:
+        lo, hi = 0, len(self.offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = self.data[self.offsets[mid] : self.offsets[mid + 1]]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def find(self, key: bytes) -> bool:
+        if key in self.added:
+            return True
+        if key in self.removed:
+            return False
+        return self.find_packed(key)
+
+    def __contains__(self, domain: str) -> bool:
+        """Whether the domain is listed exactly (not counting its parents)."""
+        return self.find(reverse_domain(normalize_domain(domain)))
+
+    def __iter__(self) -> Iterator[str]:
+        for key in self.packed_keys():
+            if key not in self.removed:
+                yield ".".join(reversed(key.decode("utf").split(".")))
+        for key in self.added:
+            yield ".".join(reversed(key.decode("utf").split(".")))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1 - len(self.removed) + len(self.added)
+
+    def match(self, domain: str) -> Optional[str]:
+        """Find the listed domain that the given domain is equal to or is a subdomain of."""
+        for suffix in reversed(domain_suffixes(domain)):
+            if self.find(reverse_domain(suffix)):
+                return suffix
+        return None
+
+    def add(self, domain: str) -> None:
+        key = reverse_domain(normalize_domain(domain))
+        self.removed.discard(key)
+        if not self.find_packed(key):
+            self.added.add(key)
+            if len(self.added) > self.MERGE_THRESHOLD:
+                self.merge()
+
+    def discard(self, domain: str) -> None:
+        key = reverse_domain(normalize_domain(domain))
+        self.added.discard(key)
+        if self.find_packed(key):
+            self.removed.add(key)
+            if len(self.removed) > self.MERGE_THRESHOLD:
+                self.merge()
+
+
+def match_local(domain: str, entries: Set[str]) -> Optional[str]:
+    """Find the entry in a local list that the given domain is equal to or is a subdomain of."""
+    for suffix in domain_suffixes(domain):
+        if suffix in entries:
+            return suffix
+        if "www." + suffix in entries:
+            return "www." + suffix
+    return None
+
+
 conf: GlobalConfig
 conf_set = asyncio.Event()
 resolve_domains: Set[str] = set()
-domains: Set[str] = set()
+domains: DomainIndex = DomainIndex()
 local_blocklist: Set[str] = set()
 local_allowlist: Set[str] = set()
 
@@ -97,16 +250,29 @@ logger = logging.getLogger(__name__)
 http: aiohttp.ClientSession = aiohttp.ClientSession()
 plugins.finalizer(http.close)
 ws_task: asyncio.Task[None]
+# Time of the last change from the feed that has been applied to domains
+domains_updated_at: Optional[datetime] = None
+# Whether domains has changed since it was last saved
+snapshot_dirty: bool = False
+# While a full refresh is downloading, changes are also collected here to be replayed onto the new list
+refresh_backlog: Optional[List[Dict[str, Any]]] = None
 
+# The API only keeps recent changes for this long, beyond that a full refresh is needed
+MAX_CATCH_UP: timedelta = timedelta(days=7)
 
-async def get_all_domains() -> List[str]:
-    if conf.api_url is None:
-        return []
 
+def api_headers() -> Dict[str, str]:
     headers = {}
     if conf.identity is not None:
         headers["X-Identity"] = conf.identity
-    async with http.get(conf.api_url + "/v2/all", headers=headers) as response:
+    return headers
+
+
+async def get_all_domains() -> List[str]:
+    if conf.api_url is None:
+        return []
+
+    async with http.get(conf.api_url + "/v2/all", headers=api_headers()) as response:
         assert response.status == 200
         assert response.headers["Content-Type"] == "application/json"
         data = json.loads(await response.text())
@@ -116,6 +282,124 @@ async def get_all_domains() -> List[str]:
         return data
 
 
+async def get_recent_changes(seconds: int) -> List[Dict[str, Any]]:
+    assert conf.api_url is not None
+    async with http.get(conf.api_url + "/v2/recent/{}".format(seconds), headers=api_headers()) as response:
+        assert response.status == 200
+        assert response.headers["Content-Type"] == "application/json"
+        data = json.loads(await response.text())
+        assert isinstance(data, list)
+        return data
+
+
+async def apply_change(payload: Dict[str, Any]) -> None:
+    global domains_updated_at, snapshot_dirty, local_blocklist, local_allowlist
+    if refresh_backlog is not None:
+        refresh_backlog.append(payload)
+    new_domains = set(cast(List[str], payload["domains"]))
+    if payload["type"] == "add":
+        for domain in new_domains:
+            domains.add(domain)
+        if unblocked := local_blocklist & new_domains:
+            async with sessionmaker() as session:
+                stmt = delete(BlockedDomain).where(BlockedDomain.domain.in_(unblocked))
+                await session.execute(stmt)
+                local_blocklist -= unblocked
+                await session.commit()
+    elif payload["type"] == "delete":
+        for domain in new_domains:
+            domains.discard(domain)
+        if unallowed := local_allowlist & new_domains:
+            async with sessionmaker() as session:
+                stmt = delete(AllowedDomain).where(AllowedDomain.domain.in_(unallowed))
+                await session.execute(stmt)
+                local_allowlist -= unallowed
+                await session.commit()
+    domains_updated_at = datetime.utcnow()
+    snapshot_dirty = True
+
+
+async def catch_up() -> None:
+    """Apply the changes made since the snapshot was taken, or do a full refresh if that's too long ago."""
+    global domains_updated_at, snapshot_dirty
+    if domains_updated_at is None or datetime.utcnow() - domains_updated_at > MAX_CATCH_UP:
+        await refresh_domains()
+        return
+    # Overlap a little: reapplying a change is harmless, missing one is not
+    started_at = datetime.utcnow()
+    seconds = int((started_at - domains_updated_at).total_seconds()) + 60
+    changes = await get_recent_changes(seconds)
+    logger.info("Catching up on {} changes from the last {} seconds".format(len(changes), seconds))
+    for payload in changes:
+        await apply_change(payload)
+    domains_updated_at, snapshot_dirty = max(domains_updated_at, started_at), True
+
+
+async def refresh_domains() -> None:
+    global domains, domains_updated_at, snapshot_dirty, local_blocklist, refresh_backlog
+    if conf.api_url is None:
+        return
+    refresh_backlog = backlog = []
+    try:
+        new_domains = DomainIndex(await get_all_domains())
+    finally:
+        refresh_backlog = None
+    for payload in backlog:
+        if payload["type"] == "add":
+            for domain in payload["domains"]:
+                new_domains.add(domain)
+        elif payload["type"] == "delete":
+            for domain in payload["domains"]:
+                new_domains.discard(domain)
+    domains, snapshot_dirty = new_domains, True
+    domains_updated_at = datetime.utcnow()
+    logger.info("Refreshed the domain list: {} domains".format(len(domains)))
+
+    if unblocked := {domain for domain in local_blocklist if domain in domains}:
+        async with sessionmaker() as session:
+            stmt = delete(BlockedDomain).where(BlockedDomain.domain.in_(unblocked))
+            await session.execute(stmt)
+            local_blocklist -= unblocked
+            await session.commit()
+    await save_snapshot()
+
+
+async def save_snapshot() -> None:
+    global snapshot_dirty
+    if not snapshot_dirty or domains_updated_at is None:
+        return
+    snapshot_dirty = False
+    try:
+        async with sessionmaker() as session:
+            if (snapshot := await session.get(Snapshot, 0)) is None:
+                session.add(Snapshot(domains=domains.dump(), updated_at=domains_updated_at))
+            else:
+                snapshot.domains = domains.dump()
+                snapshot.updated_at = domains_updated_at
+            await session.commit()
+    except:
+        snapshot_dirty = True
+        raise
+
+
+async def load_snapshot() -> Tuple[DomainIndex, Optional[datetime]]:
+    async with sessionmaker() as session:
+        if (snapshot := await session.get(Snapshot, 0)) is None:
+            return DomainIndex(), None
+        return DomainIndex.load(snapshot.domains), snapshot.updated_at
+
+
+@task(name="Phishing snapshot task", every=600, exc_backoff_base=60)
+async def snapshot_task() -> None:
+    await save_snapshot()
+
+
+@task(name="Phishing refresh task", every=86400, exc_backoff_base=60)
+async def refresh_task() -> None:
+    await conf_set.wait()
+    await refresh_domains()
+
+
 async def submit_link(link: str, reason: str) -> str:
     if conf.submit_url is None:
         return "Submission URL not configured"
@@ -129,40 +413,20 @@ async def submit_link(link: str, reason: str) -> str:
 
 @task(name="Phishing websocket task", every=0, exc_backoff_base=2)
 async def websocket_task() -> None:
-    global domains, local_blocklist, local_allowlist
     await conf_set.wait()
     if conf.api_url is None:
         await asyncio.sleep(600)
         return
 
-    headers = {}
-    if conf.identity is not None:
-        headers["X-Identity"] = conf.identity
-    ws = await http.ws_connect(conf.api_url + "/feed", headers=headers)
+    ws = await http.ws_connect(conf.api_url + "/feed", headers=api_headers())
     logger.info("Websocket connected: {!r}".format(ws))
     try:
+        # Anything that happens from now on will arrive through the websocket, fill in what we missed before that
+        await catch_up()
         async for msg in ws:
             if msg.type == aiohttp.WSMsgType.TEXT:
                 logger.debug("Got payload: {}".format(msg.data))
-                payload = json.loads(msg.data)
-                new_domains = set(payload["domains"])
-                if payload["type"] == "add":
-                    domains |= new_domains
-                    if unblocked := local_blocklist & new_domains:
-                        async with sessionmaker() as session:
-                            stmt = delete(BlockedDomain).where(BlockedDomain.domain.in_(unblocked))
-                            await session.execute(stmt)
-                            local_blocklist -= unblocked
-                            await session.commit()
-                elif payload["type"] == "delete":
-                    domains -= new_domains
-                    if unallowed := local_allowlist & new_domains:
-                        async with sessionmaker() as session:
-                            stmt = delete(AllowedDomain).where(AllowedDomain.domain.in_(unallowed))
-                            await session.execute(stmt)
-                            local_allowlist -= unallowed
-                            await session.commit()
-
+                await apply_change(json.loads(msg.data))
             elif msg.type == aiohttp.WSMsgType.CLOSED:
                 break
             elif msg.type == aiohttp.WSMsgType.ERROR:
@@ -186,26 +450,60 @@ def domain_checks(domain: str) -> Iterable[str]:
 
 
 def is_bad_domain(domain: str) -> bool:
-    checks = domain_checks(domain)
-    if any(domain in local_allowlist for domain in checks):
+    """
+    Check whether the domain or any of its parent domains is listed as malicious. A local allowlist entry for the domain
+    or any of its parents takes precedence.
+    """
+    if match_local(domain, local_allowlist) is not None:
         return False
-    if any(domain in local_blocklist for domain in checks):
-        return True
-    if any(domain in domains for domain in checks):
+    if match_local(domain, local_blocklist) is not None:
         return True
-    return False
+    return domains.match(domain) is not None
 
 
-async def resolve_link(link: str) -> Optional[str]:
+# Where shortener links lead, most recently used last: link -> (expiry as per time.monotonic, target). A target of None
+# means the link didn't redirect or couldn't be resolved.
+resolve_cache: OrderedDict[str, Tuple[float, Optional[str]]] = OrderedDict()
+# Lookups currently in progress, so that concurrent requests for the same link share one
+resolve_inflight: Dict[str, asyncio.Task[Optional[str]]] = {}
+RESOLVE_CACHE_SIZE: int = 4096
+RESOLVE_TTL: float = 3600
+RESOLVE_NEGATIVE_TTL: float = 300
+# Limit on concurrent outbound requests to shorteners
+resolve_semaphore: asyncio.Semaphore = asyncio.Semaphore(8)
+
+
+async def do_resolve_link(link: str) -> Optional[str]:
+    target = None
     try:
-        logger.debug("Looking up {!r}".format(link))
-        async with http.head(link, allow_redirects=False, timeout=5.0) as response:
-            logger.debug("Link {!r} got {}, {!r}".format(link, response.status, response.headers.get("location")))
-            if response.status in [301, 302] and "location" in response.headers:
-                return response.headers["location"]
-    except aiohttp.ClientError:
+        async with resolve_semaphore:
+            logger.debug("Looking up {!r}".format(link))
+            async with http.head(link, allow_redirects=False, timeout=5.0) as response:
+                logger.debug("Link {!r} got {}, {!r}".format(link, response.status, response.headers.get("location")))
+                if response.status in [301, 302] and "location" in response.headers:
+                    target = response.headers["location"]
+    except (aiohttp.ClientError, asyncio.TimeoutError):
         pass
-    return None
+    finally:
+        del resolve_inflight[link]
+    resolve_cache[link] = (time.monotonic() + (RESOLVE_TTL if target is not None else RESOLVE_NEGATIVE_TTL), target)
+    resolve_cache.move_to_end(link)
+    while len(resolve_cache) > RESOLVE_CACHE_SIZE:
+        resolve_cache.popitem(last=False)
+    return target
+
+
+async def resolve_link(link: str) -> Optional[str]:
+    if (cached := resolve_cache.get(link)) is not None:
+        expiry, target = cached
+        if expiry > time.monotonic():
+            resolve_cache.move_to_end(link)
+            return target
+        del resolve_cache[link]
+    if (task := resolve_inflight.get(link)) is None:
+        task = resolve_inflight[link] = asyncio.create_task(do_resolve_link(link), name="Resolving {}".format(link))
+    # Don't let one cancelled caller cancel the lookup for everyone
+    return await asyncio.shield(task)
 
 
 @plugin_command
@@ -228,17 +526,13 @@ def link_to_domain(link: str) -> str:
 async def phish_check(ctx: Context, *, link: Union[CodeBlock, Inline, Quoted]) -> None:
     """Check a link against the domain list."""
     domain = link_to_domain(link.text)
-    checks = domain_checks(domain)
     output = []
-    for check in checks:
-        if check in local_allowlist:
-            output.append(format("{!i} is listed locally as safe.", check))
-    for check in checks:
-        if check in local_blocklist:
-            output.append(format("{!i} is listed locally as malicious.", check))
-    for check in checks:
-        if check in domains:
-            output.append(format("{!i} appears in the malicious domain list.", check))
+    if (match := match_local(domain, local_allowlist)) is not None:
+        output.append(format("{!i} is listed locally as safe.", match))
+    if (match := match_local(domain, local_blocklist)) is not None:
+        output.append(format("{!i} is listed locally as malicious.", match))
+    if (match := domains.match(domain)) is not None:
+        output.append(format("{!i} appears in the malicious domain list.", match))
     if len(output) == 0:
         output.append("The domain is not listed anywhere.")
     await ctx.send("\n".join(output))
@@ -264,12 +558,9 @@ async def phish_add(ctx: Context, *, link: Union[CodeBlock, Inline, Quoted]) ->
                 output.append(format("{!i} is already listed locally as malicious.", check))
                 any_blocked = True
         if not any_blocked:
-            any_domain = False
-            for check in checks:
-                if check in domains:
-                    output.append(format("{!i} already appears in the malicious domain list.", check))
-                    any_domain = True
-            if not any_domain:
+            if (match := domains.match(domain)) is not None:
+                output.append(format("{!i} already appears in the malicious domain list.", match))
+            else:
                 session.add(BlockedDomain(domain=domain))
                 local_blocklist.add(domain)
                 output.append(
@@ -312,12 +603,8 @@ async def phish_remove(ctx: Context, *, link: Union[CodeBlock, Inline, Quoted])
                 output.append(format("{!i} is already listed locally as safe.", check))
                 any_allowed = True
         if not any_allowed:
-            any_domain = False
-            for check in checks:
-                if check in domains:
-                    output.append(format("{!i} appears in the malicious domain list.", check))
-                    any_domain = True
-            if any_domain:
+            if (match := domains.match(domain)) is not None:
+                output.append(format("{!i} appears in the malicious domain list.", match))
                 session.add(AllowedDomain(domain=domain))
                 local_allowlist.add(domain)
                 output.append(format("{!i} is now marked locally as safe.", domain))
@@ -329,7 +616,7 @@ async def phish_remove(ctx: Context, *, link: Union[CodeBlock, Inline, Quoted])
 
 @plugins.init
 async def init() -> None:
-    global conf, http, domains, local_blocklist, local_allowlist, ws_task
+    global conf, http, domains, domains_updated_at, local_blocklist, local_allowlist, resolve_domains, ws_task
     await util.db.init(util.db.get_ddl(CreateSchema("phish"), registry.metadata.create_all))
     async with sessionmaker() as session:
         c = await session.get(GlobalConfig, 0)
@@ -352,16 +639,14 @@ async def init() -> None:
         stmt = select(BlockedDomain.domain)
         local_blocklist = set((await session.execute(stmt)).scalars())
         stmt = select(AllowedDomain.domain)
-        local_blocklist = set((await session.execute(stmt)).scalars())
-        domains = set(await get_all_domains())
-
-        if unblocked := domains & local_blocklist:
-            stmt = delete(BlockedDomain).where(BlockedDomain.domain.in_(unblocked))
-            await session.execute(stmt)
-            local_blocklist -= unblocked
-            await session.commit()
+        local_allowlist = set((await session.execute(stmt)).scalars())
+        stmt = select(ResolvedDomain.domain)
+        resolve_domains = set(domain.lower() for domain in (await session.execute(stmt)).scalars())
 
-        conf_set.set()
+    # The websocket task will catch up from the snapshot, or fetch the whole list if there is no usable snapshot
+    domains, domains_updated_at = await load_snapshot()
+    conf_set.set()
+    plugins.finalizer(save_snapshot)
 
 
 @plugin_config_command
@@ -450,6 +735,7 @@ async def config_shortener_add(ctx: Context, domain: str) -> None:
     async with sessionmaker() as session:
         session.add(ResolvedDomain(domain=domain))
         await session.commit()
+        resolve_domains.add(domain.lower())
         await ctx.send("\u2705")
 
 
@@ -459,4 +745,5 @@ async def config_shortener_remove(ctx: Context, domain: str) -> None:
     async with sessionmaker() as session:
         await session.delete(await session.get(ResolvedDomain, domain))
         await session.commit()
+        resolve_domains.discard(domain.lower())
         await ctx.send("\u2705")
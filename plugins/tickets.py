@@ -53,6 +53,7 @@ from sqlalchemy import (
     TIMESTAMP,
     BigInteger,
     Column,
+    Computed,
     ForeignKey,
     Integer,
     MetaData,
@@ -408,6 +409,10 @@ class Ticket:
         TIMESTAMP, nullable=False, default=func.current_timestamp().op("AT TIME ZONE")("UTC")
     )
     modified_by: Mapped[Optional[int]] = mapped_column(BigInteger)
+    # Same as expiry, except for ticket types that cannot be reverted
+    expires_at: Mapped[Optional[datetime]] = mapped_column(
+        TIMESTAMP, Computed("created_at + duration * INTERVAL '1 second'")
+    )
 
     mod: Mapped[TicketMod] = relationship(TicketMod, lazy="joined")
     __mapper_args__ = {"polymorphic_on": type}
@@ -501,7 +506,21 @@ class Ticket:
         # Reschedule or cancel ticket expiry if required
         expiry_task.run_coalesced(1)
 
-        # Post to or update the ticket list
+        await self.publish_list_message()
+
+        # Run mod ticket update hook
+        await self.mod.ticket_updated(self)
+
+    async def publish_list_message(self) -> None:
+        """Post to or update the ticket list."""
+        if await self.update_list_message():
+            await self.post_list_message()
+
+    async def update_list_message(self) -> bool:
+        """
+        Update or delete the existing ticket list message, and return whether a new one needs to be posted. Doesn't
+        use the database, so can run concurrently for multiple tickets.
+        """
         if conf.ticket_list:
             channel = client.get_channel(conf.ticket_list)
             if isinstance(channel, (TextChannel, Thread)):
@@ -525,13 +544,16 @@ class Ticket:
                         except discord.HTTPException:
                             pass
 
-                if message is None and not self.hidden:
-                    message = await channel.send(embed=self.to_embed())
-                    self.list_msgid = message.id
-                    cleanup_exempt.add(message.id)
+                return message is None and not self.hidden
+        return False
 
-        # Run mod ticket update hook
-        await self.mod.ticket_updated(self)
+    async def post_list_message(self) -> None:
+        """Post a new message to the ticket list."""
+        channel = client.get_channel(conf.ticket_list) if conf.ticket_list else None
+        if isinstance(channel, (TextChannel, Thread)):
+            message = await channel.send(embed=self.to_embed())
+            self.list_msgid = message.id
+            cleanup_exempt.add(message.id)
 
     @staticmethod
     @asynccontextmanager
@@ -549,8 +571,7 @@ class Ticket:
             if isinstance(obj, Ticket):
                 tickets.append(obj)
         yield None
-        for ticket in tickets:
-            await ticket.publish()
+        await publish_tickets(tickets)
 
     async def get_related(self, session: AsyncSession) -> Sequence[Ticket]:
         stmt = select(Ticket).where(
@@ -1298,6 +1319,9 @@ async def init_db() -> None:
             DDL(
                 r"""
             CREATE INDEX tickets_mod_queue ON tickets.tickets USING BTREE (modid, id) WHERE stage <> 'COMMENTED';
+            CREATE INDEX tickets_expires_at ON tickets.tickets USING BTREE (expires_at) WHERE status = 'IN_EFFECT';
+            CREATE INDEX tickets_targetid_status ON tickets.tickets USING BTREE (targetid, status);
+            CREATE INDEX tickets_list_msgid ON tickets.tickets USING BTREE (list_msgid);
 
             CREATE VIEW tickets.mod_queues AS
                 SELECT tkt.id AS id
@@ -1384,57 +1408,191 @@ async def init_db() -> None:
 
 
 # ----------- Audit logs -----------
+audit_lock: asyncio.Lock = asyncio.Lock()
+# Whether conf.last_auditid is known to be up to date with the gateway, so that audit entries can be processed as they
+# arrive. Cleared whenever we might have missed an entry, until the audit log task catches up with the API.
+audit_in_sync: bool = False
+AUDIT_SAVE_INTERVAL = 100
+
+
+async def process_audit_entry(session: AsyncSession, entry: AuditLogEntry) -> None:
+    try:
+        logger.debug("Processing audit entry {}".format(entry))
+        for create_handler in create_handlers.get(entry.action, ()):
+            for ticket in await create_handler(session, entry):
+                session.add(ticket)
+                update_unapproved_list.run_coalesced(30)
+                logger.debug("Created {!r} from audit {}".format(ticket.describe(), entry.id))
+                await session.commit()  # to get ID
+                await ticket.publish()
+        for update_handler in update_handlers.get(entry.action, ()):
+            for ticket in await update_handler(session, entry):
+                if entry.user is not None:
+                    ticket.modified_by = entry.user.id
+                logger.debug("Updated Ticket #{} from audit {}".format(ticket.id, entry.id))
+                await ticket.publish()
+        for revert_handler in revert_handlers.get(entry.action, ()):
+            for ticket in await revert_handler(session, entry):
+                ticket.status = TicketStatus.REVERTED
+                if entry.user is not None:
+                    ticket.modified_by = entry.user.id
+                logger.debug("Reverted Ticket #{} from audit {}".format(ticket.id, entry.id))
+                await ticket.publish()
+        await session.commit()
+    except asyncio.CancelledError:
+        raise
+    except:
+        logger.error("Processing audit entry {}".format(entry), exc_info=True)
+        await session.rollback()
+
+
+def has_audit_handlers(action: AuditLogAction) -> bool:
+    return action in create_handlers or action in update_handlers or action in revert_handlers
+
+
 @task(name="Audit log task", every=600, exc_backoff_base=10)
 async def audit_log_task() -> None:
+    """
+    Catch up with the audit log through the API. New entries are normally processed as they arrive from the gateway,
+    this is only needed after we could have missed some.
+    """
+    global audit_in_sync
     await client.wait_until_ready()
     if not conf.guild or not (guild := client.get_guild(conf.guild)):
         logger.error("Guild not configured, or can't find the configured guild! Cannot read audit log.")
         return
 
-    last = conf.last_auditid
+    async with audit_lock:
+        last = conf.last_auditid
+        try:
+            logger.debug("Reading audit entries since {}".format(last))
+            if last is None:
+                entries = guild.audit_logs(limit=1)
+            else:
+                # Entries are fetched a page at a time, oldest first
+                entries = guild.audit_logs(limit=None, after=Object(last), oldest_first=True)
+            count = 0
+            async with sessionmaker() as session:
+                async for entry in entries:
+                    if has_audit_handlers(entry.action):
+                        await process_audit_entry(session, entry)
+                    last = entry.id
+                    count += 1
+                    if count % AUDIT_SAVE_INTERVAL == 0:
+                        conf.last_auditid = last
+                        await conf
+            audit_in_sync = True
+        finally:
+            conf.last_auditid = last
+            await conf
+
+
+# ----------- Ticket publishing -----------
+PUBLISH_CONCURRENCY = 5
+PUBLISH_RETRIES = 5
+publish_semaphore: asyncio.Semaphore = asyncio.Semaphore(PUBLISH_CONCURRENCY)
+# IDs of tickets that are waiting to be published or being published, with the number of batches publishing each. The
+# sum of the counts is the depth of the publish queue.
+publish_queue: Dict[int, int] = {}
+# Tickets whose publishing failed, to be retried by publish_retry_task, with the number of failed attempts
+failed_publishes: Dict[int, int] = {}
+
+
+def publish_failed(ticket: Ticket) -> None:
+    logger.error("Exception when publishing Ticket #{}".format(ticket.id), exc_info=True)
+    if (attempts := failed_publishes.get(ticket.id, 0) + 1) < PUBLISH_RETRIES:
+        failed_publishes[ticket.id] = attempts
+    else:
+        failed_publishes.pop(ticket.id, None)
+        logger.error("Giving up on publishing Ticket #{}".format(ticket.id))
+
+
+def dequeue_publish(id: int) -> None:
+    if (count := publish_queue.get(id, 0) - 1) > 0:
+        publish_queue[id] = count
+    else:
+        publish_queue.pop(id, None)
+
+
+async def publish_tickets(tickets: Sequence[Ticket]) -> None:
+    """
+    Publish multiple tickets. Existing ticket list messages are updated concurrently, up to PUBLISH_CONCURRENCY at a
+    time (discord.py additionally waits for the rate limits of the channel). New ticket list messages are then posted
+    one at a time in order of ticket ID, so that the list stays in order. The mod update hooks use the tickets'
+    session, so they are run one at a time afterwards. A failure is logged and the ticket is queued for a retry,
+    without affecting the other tickets.
+    """
+    if not tickets:
+        return
+    # IDs of this batch's tickets that are still counted in the queue
+    pending = set(ticket.id for ticket in tickets)
+    for id in pending:
+        publish_queue[id] = publish_queue.get(id, 0) + 1
+    logger.debug("Publishing {} tickets, {} in queue".format(len(tickets), sum(publish_queue.values())))
+
+    def finish(ticket: Ticket) -> None:
+        if ticket.id in pending:
+            pending.discard(ticket.id)
+            dequeue_publish(ticket.id)
+
+    async def update_list_message(ticket: Ticket) -> Optional[bool]:
+        try:
+            async with publish_semaphore:
+                return await ticket.update_list_message()
+        except asyncio.CancelledError:
+            raise
+        except:
+            publish_failed(ticket)
+            finish(ticket)
+            return None
+
     try:
-        logger.debug("Reading audit entries since {}".format(last))
-        # audit_logs(after) is currently broken so we read the entire audit
-        # log in reverse chronological order and reverse it
-        entries = []
-        async for entry in guild.audit_logs(limit=None if last else 1, oldest_first=False):
-            if last and entry.id <= last:
-                break
-            entries.append(entry)
-        async with sessionmaker() as session:
-            for entry in reversed(entries):
+        expiry_task.run_coalesced(1)
+        updated = await asyncio.gather(*(update_list_message(ticket) for ticket in tickets))
+        published = []
+        for ticket, post in sorted(zip(tickets, updated), key=lambda item: item[0].id):
+            if post:
                 try:
-                    logger.debug("Processing audit entry {}".format(entry))
-                    last = entry.id
-                    for create_handler in create_handlers.get(entry.action, ()):
-                        for ticket in await create_handler(session, entry):
-                            session.add(ticket)
-                            update_unapproved_list.run_coalesced(30)
-                            logger.debug("Created {!r} from audit {}".format(ticket.describe(), entry.id))
-                            await session.commit()  # to get ID
-                            await ticket.publish()
-                    for update_handler in update_handlers.get(entry.action, ()):
-                        for ticket in await update_handler(session, entry):
-                            if entry.user is not None:
-                                ticket.modified_by = entry.user.id
-                            logger.debug("Updated Ticket #{} from audit {}".format(ticket.id, entry.id))
-                            await ticket.publish()
-                    for revert_handler in revert_handlers.get(entry.action, ()):
-                        for ticket in await revert_handler(session, entry):
-                            ticket.status = TicketStatus.REVERTED
-                            if entry.user is not None:
-                                ticket.modified_by = entry.user.id
-                            logger.debug("Reverted Ticket #{} from audit {}".format(ticket.id, entry.id))
-                            await ticket.publish()
+                    await ticket.post_list_message()
                 except asyncio.CancelledError:
                     raise
                 except:
-                    logger.error("Processing audit entry {}".format(entry), exc_info=True)
-            await session.commit()
+                    publish_failed(ticket)
+                    finish(ticket)
+                    continue
+            if post is not None:
+                published.append(ticket)
 
+        for ticket in published:
+            try:
+                await ticket.mod.ticket_updated(ticket)
+            except asyncio.CancelledError:
+                raise
+            except:
+                publish_failed(ticket)
+            else:
+                failed_publishes.pop(ticket.id, None)
+            finish(ticket)
     finally:
-        conf.last_auditid = last
-        await conf
+        for id in pending:
+            dequeue_publish(id)
+        if failed_publishes:
+            publish_retry_task.run_coalesced(60)
+
+
+@task(name="Ticket publish retry task", exc_backoff_base=60)
+async def publish_retry_task() -> None:
+    await client.wait_until_ready()
+    if not failed_publishes:
+        return
+    logger.debug("Retrying publishing of tickets {!r}".format(list(failed_publishes)))
+    async with sessionmaker() as session:
+        stmt = select(Ticket).where(Ticket.id.in_(list(failed_publishes)))
+        tickets = (await session.execute(stmt)).scalars().all()
+        for id in failed_publishes.keys() - set(ticket.id for ticket in tickets):
+            del failed_publishes[id]
+        await publish_tickets(tickets)
+        await session.commit()
 
 
 # ----------- Ticket expiry system -----------
@@ -1442,25 +1600,31 @@ async def audit_log_task() -> None:
 async def expiry_task() -> None:
     await client.wait_until_ready()
 
+    types = [
+        mapper.polymorphic_identity
+        for mapper in sqlalchemy.orm.class_mapper(Ticket).self_and_descendants
+        if getattr(mapper.class_, "can_revert", False)
+    ]
     async with sessionmaker() as session:
-        min_expiry = None
         now = datetime.utcnow()
-        stmt = select(Ticket).where(Ticket.status == TicketStatus.IN_EFFECT, Ticket.duration != None)
-        for (ticket,) in await session.execute(stmt):
-            if (expiry := ticket.expiry) is None:
-                continue
-            if expiry <= now:
-                try:
-                    await ticket.expire()
-                except asyncio.CancelledError:
-                    raise
-                except:
-                    logger.error("Exception when expiring Ticket #{}".format(ticket.id), exc_info=True)
-            elif min_expiry is None or expiry < min_expiry:
-                min_expiry = expiry
+        stmt = select(Ticket).where(
+            Ticket.status == TicketStatus.IN_EFFECT, Ticket.expires_at <= now, Ticket.type.in_(types)
+        )
+        for ticket in (await session.execute(stmt)).scalars().all():
+            try:
+                await ticket.expire()
+            except asyncio.CancelledError:
+                raise
+            except:
+                logger.error("Exception when expiring Ticket #{}".format(ticket.id), exc_info=True)
         async with Ticket.publish_all(session):
             await session.commit()
 
+        stmt = select(func.min(Ticket.expires_at)).where(
+            Ticket.status == TicketStatus.IN_EFFECT, Ticket.expires_at > now, Ticket.type.in_(types)
+        )
+        min_expiry = (await session.execute(stmt)).scalar()
+
     if min_expiry is not None:
         delay = (min_expiry - datetime.utcnow()).total_seconds()
         logger.debug("Waiting for upcoming expiration in {} seconds".format(delay))
@@ -2033,16 +2197,37 @@ class Tickets(Cog):
 
             await ctx.send(embed=Embed(description="[#{}]({}): Ticket approved.".format(tkt.id, tkt.jump_link)))
 
-    @Cog.listener("on_member_ban")
-    @Cog.listener("on_member_unban")
-    @Cog.listener("on_member_remove")
-    async def on_member_remove(self, *args: object) -> None:
+    @Cog.listener("on_ready")
+    async def on_ready(self) -> None:
+        global audit_in_sync
+        # Reconnected without resuming, we might have missed audit entries
+        audit_in_sync = False
         audit_log_task.run_coalesced(conf.audit_log_precision)
 
+    @Cog.listener("on_audit_log_entry_create")
+    async def on_audit_log_entry_create(self, entry: AuditLogEntry) -> None:
+        global audit_in_sync
+        if entry.guild.id != conf.guild or not has_audit_handlers(entry.action):
+            return
+        async with audit_lock:
+            if not audit_in_sync or conf.last_auditid is None:
+                audit_log_task.run_coalesced(conf.audit_log_precision)
+                return
+            if entry.id <= conf.last_auditid:
+                return
+            if entry.user is None or isinstance(entry.target, Object):
+                # The gateway event doesn't include the users involved, and they aren't cached. The API does include
+                # them, so let the audit log task process this entry.
+                audit_in_sync = False
+                audit_log_task.run_coalesced(conf.audit_log_precision)
+                return
+            async with sessionmaker() as session:
+                await process_audit_entry(session, entry)
+            conf.last_auditid = entry.id
+            await conf
+
     @Cog.listener("on_voice_state_update")
     async def process_voice_state(self, member: Member, before: VoiceState, after: VoiceState) -> None:
-        if before.deaf != after.deaf or before.mute != after.mute:
-            audit_log_task.run_coalesced(conf.audit_log_precision)
         if after.channel is not None:
             async with voice_lock:
                 if member.id in conf.pending_unmutes:
@@ -2064,11 +2249,6 @@ class Tickets(Cog):
                         if exc.text != "Target user is not connected to voice.":
                             raise
 
-    @Cog.listener("on_member_update")
-    async def process_member_update(self, before: Member, after: Member) -> None:
-        if before.roles != after.roles or before.timed_out_until != after.timed_out_until:
-            audit_log_task.run_coalesced(conf.audit_log_precision)
-
     @Cog.listener("on_message")
     async def moderator_message(self, msg: Message) -> None:
         if msg.channel.type == ChannelType.private:
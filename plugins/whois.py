@@ -1,31 +1,54 @@
 from __future__ import annotations
 
+from array import array
 import asyncio
-from bisect import bisect_left
-from collections import defaultdict
+from bisect import bisect_right
 from dataclasses import dataclass, field
 import enum
 from functools import total_ordering
 import heapq
 import itertools
 import logging
-import re
+import mmap
+import os
+import struct
 import threading
-from typing import Dict, Generic, Iterable, Iterator, List, Literal, Optional, Sequence, Set, Tuple, TypeVar, Union
+from time import monotonic, perf_counter
+from typing import (
+    Dict,
+    FrozenSet,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Mapping,
+    Optional,
+    Protocol,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
 
 import datrie
 import discord
 from discord import Embed, Guild, Interaction, Member, RawMemberRemoveEvent, User
 from discord.app_commands import Choice, default_permissions, guild_only
 from discord.utils import snowflake_time
-from sqlalchemy import func, select
+from sqlalchemy import func, literal_column, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from bot.client import client
 from bot.cogs import Cog, cog
 from bot.interactions import command
+from bot.tasks import task
+import plugins
 import plugins.log
 import plugins.tickets
+import util.db.kv
 from util.discord import PlainItem, chunk_messages, format
 
 
@@ -68,6 +91,14 @@ class IdTrie:
     def delete(self, value: int) -> None:
         self.trie.pop(str(value), None)
 
+    def reconcile(self, values: Iterable[int]) -> None:
+        """Make the trie contain exactly the given values"""
+        keys = set(str(value) for value in values)
+        for key in set(self.trie.keys()) - keys:
+            del self.trie[key]
+        for key in keys:
+            self.trie[key] = int(key)
+
     def lookup(self, input: str) -> Iterable[InfixCandidate[int]]:
         return sorted(
             InfixCandidate(
@@ -77,116 +108,278 @@ class IdTrie:
         )
 
 
-class InfixTrie:
-    # Most common characters to appear in nicknames and usernames
-    common_chars = " #.0123456789_abcdefghijklmnopqrstuvwxyz"
-    assert len(common_chars) <= 254
-    uncommon_re = re.compile("[^" + re.escape(common_chars) + "]")
+class NameIndex:
+    """
+    Substring index of names. The lowercased names are concatenated into a single newline-separated string, sorted by
+    length, so that scanning it with str.find yields exact, prefix and infix matches already in order of increasing
+    length. Recent changes are kept in a small overlay which is merged into the string once it grows large.
+    """
 
-    tries: Dict[int, datrie.Trie[List[int]]]
-    uncommon: Dict[str, Dict[int, str]]
-    lock: threading.Lock
+    MERGE_THRESHOLD = 1024
 
-    @classmethod
-    def make_trie(cls) -> datrie.Trie:  # type: ignore
-        return datrie.Trie("\n" + cls.common_chars)
+    names: Dict[int, str]
+    blob: str
+    # Start of each name in the blob, followed by the end of the blob
+    offsets: array[int]
+    values: array[int]
+    added: Dict[int, str]
+    removed: Set[int]
+    lock: threading.Lock
 
     def __init__(self):
-        self.tries = defaultdict(self.make_trie)
-        self.uncommon = defaultdict(dict)
+        self.names = {}
+        self.blob = "\n"
+        self.offsets = array("Q", (1,))
+        self.values = array("Q")
+        self.added = {}
+        self.removed = set()
         self.lock = threading.Lock()
 
-    def common_key_iter(self, key: str) -> Iterator[Tuple[datrie.Trie, str]]:  # type: ignore
-        common_key = re.sub(self.uncommon_re, "\n", key)
-        for i in range(len(common_key)):
-            if common_key[i] != "\n":
-                yield self.tries[i], common_key[i:]
+    def merge(self) -> None:
+        items = sorted(self.names.items(), key=lambda item: len(item[1]))
+        offsets = array("Q")
+        pos = 1
+        for _, key in items:
+            offsets.append(pos)
+            pos += len(key) + 1
+        offsets.append(pos)
+        self.blob = "\n" + "".join(key + "\n" for _, key in items)
+        self.offsets = offsets
+        self.values = array("Q", (value for value, _ in items))
+        self.added = {}
+        self.removed = set()
+
+    def maybe_merge(self) -> None:
+        if len(self.added) + len(self.removed) > self.MERGE_THRESHOLD:
+            self.merge()
+
+    @staticmethod
+    def normalize(key: str) -> str:
+        return key.lower().replace("\n", " ")
 
     def insert(self, key: str, value: int) -> None:
-        key = key.lower()
+        """Set the name of the given value, replacing any previous one"""
+        key = self.normalize(key)
         with self.lock:
-            for ch in re.findall(self.uncommon_re, key):
-                self.uncommon[ch][value] = key
-            for trie, trie_key in self.common_key_iter(key):
-                if (l := trie.get(trie_key)) is not None:
-                    l.insert(bisect_left(l, value), value)
-                else:
-                    trie[trie_key] = [value]
+            self.names[value] = key
+            self.added[value] = key
+            self.removed.add(value)
+            self.maybe_merge()
+
+    def reconcile(self, items: Iterable[Tuple[str, int]]) -> int:
+        """Make the index contain exactly the given names, and return the number of changes"""
+        names = {value: self.normalize(key) for key, value in items}
+        with self.lock:
+            changed = [value for value, key in names.items() if self.names.get(value) != key]
+            gone = [value for value in self.names if value not in names]
+            if len(changed) + len(gone) + len(self.added) + len(self.removed) > self.MERGE_THRESHOLD:
+                self.names = names
+                self.merge()
+            else:
+                for value in changed:
+                    self.names[value] = self.added[value] = names[value]
+                    self.removed.add(value)
+                for value in gone:
+                    del self.names[value]
+                    self.added.pop(value, None)
+                    self.removed.add(value)
+        return len(changed) + len(gone)
+
+    def dump(self) -> List[bytes]:
+        """
+        Serialize the index as: the number of names and the byte length of the string (two native 64-bit integers), the
+        offsets array, the values array, and the UTF-8 string padded to a multiple of 8 bytes.
+        """
+        with self.lock:
+            if self.added or self.removed:
+                self.merge()
+            blob, offsets, values = self.blob, self.offsets, self.values
+        data = blob.encode("utf8")
+        padding = b"\0" * (-len(data) % 8)
+        return [struct.pack("=QQ", len(values), len(data)), offsets.tobytes(), values.tobytes(), data, padding]
+
+    @classmethod
+    def load(cls, buf: Union[bytes, mmap.mmap], pos: int) -> Tuple[NameIndex, int]:
+        """Deserialize an index at the given position in the buffer, and return it with the position after it"""
+        count, size = struct.unpack_from("=QQ", buf, pos)
+        pos += 16
+        offsets = array("Q")
+        offsets.frombytes(buf[pos : pos + 8 * (count + 1)])
+        pos += 8 * (count + 1)
+        values = array("Q")
+        values.frombytes(buf[pos : pos + 8 * count])
+        pos += 8 * count
+        blob = buf[pos : pos + size].decode("utf8")
+        pos += size + -size % 8
+        if len(offsets) != count + 1 or len(values) != count or offsets[-1] != len(blob):
+            raise ValueError("Truncated index")
+
+        index = cls()
+        index.blob, index.offsets, index.values = blob, offsets, values
+        index.names = dict(zip(values, blob[1:].split("\n")))
+        return index, pos
 
     def delete(self, key: str, value: int) -> None:
-        key = key.lower()
+        key = self.normalize(key)
         with self.lock:
-            for ch in re.findall(self.uncommon_re, key):
-                self.uncommon[ch].pop(value, None)
-            for trie, trie_key in self.common_key_iter(key):
-                if (l := trie.get(trie_key)) is not None:
-                    i = bisect_left(l, value)
-                    if i < len(l) and l[i] == value:
-                        l.pop(i)
-                        if not l:
-                            del trie[trie_key]
+            if self.names.get(value) == key:
+                del self.names[value]
+                self.added.pop(value, None)
+                self.removed.add(value)
+                self.maybe_merge()
+
+    @staticmethod
+    def scan(
+        input: str, blob: str, offsets: array[int], values: array[int], skip: FrozenSet[int]
+    ) -> Iterator[InfixCandidate[int]]:
+        needle = "\n" + input
+        pos = blob.find(needle)
+        while pos >= 0:
+            i = bisect_right(offsets, pos + 1) - 1
+            if values[i] not in skip:
+                if (length := offsets[i + 1] - offsets[i] - 1) == len(input):
+                    yield InfixCandidate((InfixType.EXACT,), values[i])
+                else:
+                    yield InfixCandidate((InfixType.PREFIX, length - len(input)), values[i])
+            pos = blob.find(needle, offsets[i + 1] - 1)
+
+        pos = blob.find(input, 1)
+        while pos >= 0:
+            i = bisect_right(offsets, pos) - 1
+            if pos == offsets[i]:
+                # Prefix match, but there could be another occurrence further in the name
+                pos = blob.find(input, pos + 1)
+                continue
+            if values[i] not in skip and not blob.startswith(input, offsets[i]):
+                yield InfixCandidate((InfixType.INFIX, offsets[i + 1] - offsets[i] - 1 - len(input)), values[i])
+            pos = blob.find(input, offsets[i + 1])
 
     def lookup(self, input: str) -> Iterator[InfixCandidate[int]]:
-        """Returned value might not actually be a match"""
         input = input.lower()
+        if not input or "\n" in input:
+            return iter(())
         with self.lock:
-            uncommon: Dict[int, str]
-            try:
-                uncommon = min(
-                    (d for ch in re.findall(self.uncommon_re, input) if (d := self.uncommon.get(ch)) is not None),
-                    key=len,
-                )
-            except ValueError:
-                uncommon = {}
-
-            def uncommon_iter() -> Iterator[InfixCandidate[int]]:
-                for value, key in uncommon.items():
-                    if key == input:
-                        yield InfixCandidate((InfixType.EXACT,), value)
-                    elif key.startswith(input):
-                        yield InfixCandidate((InfixType.PREFIX, len(key) - len(input)), value)
-                    elif input in key:
-                        yield InfixCandidate((InfixType.INFIX, len(key) - len(input)), value)
-
-            common_key = re.sub(self.uncommon_re, "\n", input)
-
-            def prefix_iter() -> Iterator[InfixCandidate[List[int]]]:
-                for key, values in self.tries[0].items(common_key):
-                    if key == input:
-                        yield InfixCandidate((InfixType.EXACT,), values)
-                    else:
-                        yield InfixCandidate((InfixType.PREFIX, len(key) - len(input)), values)
-
-            def infix_iter(i: int) -> Iterator[InfixCandidate[List[int]]]:
-                for key, values in self.tries[i].items(common_key):
-                    yield InfixCandidate((InfixType.INFIX, i + len(key) - len(input)), values)
-
-            def prefix_iter_sorted(i: int) -> Iterator[InfixCandidate[List[int]]]:
-                yield InfixCandidate((InfixType.INFIX, i), [])
-                yield from sorted(infix_iter(i))
-
-            for candidate in heapq.merge(
-                sorted(uncommon_iter()),
-                sorted(prefix_iter()),
-                *(prefix_iter_sorted(i) for i in range(1, max(self.tries) + 1)),
-            ):
-                if isinstance(candidate.match, int):
-                    yield candidate  # type:ignore
-                else:
-                    for value in candidate.match:
-                        yield InfixCandidate(candidate.rank, value)
+            # The blob and arrays are replaced rather than modified, so the scan can continue without the lock
+            blob, offsets, values, skip = self.blob, self.offsets, self.values, frozenset(self.removed)
+            recent: List[InfixCandidate[int]] = []
+            for value, key in self.added.items():
+                if (pos := key.find(input)) > 0:
+                    recent.append(InfixCandidate((InfixType.INFIX, len(key) - len(input)), value))
+                elif pos == 0 and len(key) > len(input):
+                    recent.append(InfixCandidate((InfixType.PREFIX, len(key) - len(input)), value))
+                elif pos == 0:
+                    recent.append(InfixCandidate((InfixType.EXACT,), value))
+        recent.sort()
+        return heapq.merge(recent, self.scan(input, blob, offsets, values, skip))
 
 
 id_trie: IdTrie = IdTrie()
-username_trie: InfixTrie = InfixTrie()
-displayname_trie: InfixTrie = InfixTrie()
-nickname_trie: InfixTrie = InfixTrie()
+username_index: NameIndex = NameIndex()
+displayname_index: NameIndex = NameIndex()
+# Nicknames are per guild, so each guild gets its own index
+nickname_indices: Dict[int, NameIndex] = {}
+
+
+def get_nickname_index(guild_id: int) -> NameIndex:
+    if (index := nickname_indices.get(guild_id)) is None:
+        index = nickname_indices[guild_id] = NameIndex()
+    return index
+
+
+# The name indices are saved to a file periodically and on unload, so that they are available right away on startup,
+# and only need to be reconciled with the member cache once it's ready.
+class WhoisConf(Protocol):
+    snapshot_path: Optional[str]
+
+
+conf: WhoisConf
+
+SNAPSHOT_MAGIC: bytes = b"WHOISIX2"
+
+snapshot_dirty: bool = False
+
+
+def write_snapshot(path: str, indices: Sequence[NameIndex], nickname_indices: Mapping[int, NameIndex]) -> None:
+    """Write the given indices, followed by the number of guilds, and the ID and nickname index of each guild"""
+    chunks = [SNAPSHOT_MAGIC]
+    for index in indices:
+        chunks.extend(index.dump())
+    chunks.append(struct.pack("=Q", len(nickname_indices)))
+    for guild_id, index in nickname_indices.items():
+        chunks.append(struct.pack("=Q", guild_id))
+        chunks.extend(index.dump())
+    with open(path + ".tmp", "wb") as f:
+        f.writelines(chunks)
+    os.replace(path + ".tmp", path)
+
+
+def read_snapshot(path: str) -> Optional[Tuple[List[NameIndex], Dict[int, NameIndex]]]:
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if buf[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError("Bad magic")
+            pos = len(SNAPSHOT_MAGIC)
+            indices = []
+            for _ in range(2):
+                index, pos = NameIndex.load(buf, pos)
+                indices.append(index)
+            (count,) = struct.unpack_from("=Q", buf, pos)
+            pos += 8
+            nickname_indices = {}
+            for _ in range(count):
+                (guild_id,) = struct.unpack_from("=Q", buf, pos)
+                nickname_indices[guild_id], pos = NameIndex.load(buf, pos + 8)
+            return indices, nickname_indices
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error):
+        logger.warning("Could not load the index snapshot", exc_info=True)
+        return None
+
+
+@plugins.init
+async def init() -> None:
+    global conf, id_trie, username_index, displayname_index, nickname_indices
+    conf = cast(WhoisConf, await util.db.kv.load(__name__))
+    if conf.snapshot_path is None:
+        return
+
+    def load_indices(path: str) -> Optional[Tuple[IdTrie, List[NameIndex], Dict[int, NameIndex]]]:
+        if (result := read_snapshot(path)) is None:
+            return None
+        indices, nickname_indices = result
+        id_trie = IdTrie()
+        id_trie.reconcile(indices[0].names)
+        return id_trie, indices, nickname_indices
+
+    if (result := await asyncio.get_event_loop().run_in_executor(None, load_indices, conf.snapshot_path)) is not None:
+        id_trie, (username_index, displayname_index), nickname_indices = result
+        logger.debug("Loaded index snapshot with {} users".format(len(username_index.names)))
+
+
+@task(name="Whois snapshot task", every=600)
+async def snapshot_task() -> None:
+    global snapshot_dirty
+    if conf.snapshot_path is None or not snapshot_dirty:
+        return
+    snapshot_dirty = False
+    await asyncio.get_event_loop().run_in_executor(
+        None, write_snapshot, conf.snapshot_path, (username_index, displayname_index), dict(nickname_indices)
+    )
 
 
 @plugins.finalizer
-def deallocate_tries() -> None:
-    global id_trie, username_trie, displayname_trie, nickname_trie
-    del id_trie, username_trie, displayname_trie, nickname_trie
+def deallocate_indices() -> None:
+    global id_trie, username_index, displayname_index, nickname_indices
+    try:
+        if snapshot_dirty and conf.snapshot_path is not None:
+            write_snapshot(conf.snapshot_path, (username_index, displayname_index), nickname_indices)
+    except NameError:
+        # Not initialized
+        pass
+    except OSError:
+        logger.error("Could not save the index snapshot", exc_info=True)
+    del id_trie, username_index, displayname_index, nickname_indices
 
 
 @total_ordering
@@ -234,6 +427,7 @@ def rank_server_status(m: Optional[Member]) -> ServerStatus:
 
 def rank_recent_match(text: str, recent: Recent, server_status: ServerStatus) -> MatchRank:
     _, match, nu, infix = recent
+    text = text.lower()
     if text == match:
         if nu == NickOrUser.USER:
             return MatchType.EXACT_RECENT_USER, server_status
@@ -266,7 +460,7 @@ async def select_candidates(limit: int, input: str, guild: Guild, session: Async
                     yield Candidate((MatchType.PREFIX_ID, server_status, candidate.match), member)
 
     def username_iter() -> Iterator[Candidate]:
-        for candidate in username_trie.lookup(input):
+        for candidate in username_index.lookup(input):
             if (member := guild.get_member(candidate.match)) is not None:
                 if input.lower() in (member.name + "#" + member.discriminator).lower():
                     server_status = rank_server_status(member)
@@ -278,7 +472,7 @@ async def select_candidates(limit: int, input: str, guild: Guild, session: Async
                         yield Candidate((MatchType.INFIX, candidate.rank[1], NickOrUser.USER, server_status), member)
 
     def displayname_iter() -> Iterator[Candidate]:
-        for candidate in displayname_trie.lookup(input):
+        for candidate in displayname_index.lookup(input):
             if (member := guild.get_member(candidate.match)) is not None:
                 if input.lower() in member.display_name.lower():
                     server_status = rank_server_status(member)
@@ -290,7 +484,9 @@ async def select_candidates(limit: int, input: str, guild: Guild, session: Async
                         yield Candidate((MatchType.INFIX, candidate.rank[1], NickOrUser.NICK, server_status), member)
 
     def nickname_iter() -> Iterator[Candidate]:
-        for candidate in nickname_trie.lookup(input):
+        if (nickname_index := nickname_indices.get(guild.id)) is None:
+            return
+        for candidate in nickname_index.lookup(input):
             if (member := guild.get_member(candidate.match)) is not None:
                 if member.nick is not None and input.lower() in member.nick.lower():
                     server_status = rank_server_status(member)
@@ -302,10 +498,14 @@ async def select_candidates(limit: int, input: str, guild: Guild, session: Async
                         yield Candidate((MatchType.INFIX, candidate.rank[1], NickOrUser.NICK, server_status), member)
 
     def recent_iter(recents: Iterable[Recent]) -> Iterator[Candidate]:
+        # The query can only order by exactness and length, the server status has to be ranked here
+        ranked = []
         for recent in recents:
             server_status = rank_server_status(guild.get_member(recent[0]))
             rank = rank_recent_match(input, recent, server_status)
-            yield Candidate(rank, recent)
+            ranked.append(Candidate(rank, recent))
+        ranked.sort()
+        return iter(ranked)
 
     def unique_candidates(iter: Iterable[Candidate]) -> Iterator[Candidate]:
         ids: Set[int] = set()
@@ -328,7 +528,9 @@ async def select_candidates(limit: int, input: str, guild: Guild, session: Async
         candidates = list(
             itertools.islice(
                 unique_candidates(
-                    heapq.merge(candidates, recent_iter(await match_recents(session, input, NickOrUser.USER, False)))
+                    heapq.merge(
+                        candidates, recent_iter(await match_recents(session, input, NickOrUser.USER, False, limit))
+                    )
                 ),
                 limit,
             )
@@ -339,7 +541,9 @@ async def select_candidates(limit: int, input: str, guild: Guild, session: Async
         candidates = list(
             itertools.islice(
                 unique_candidates(
-                    heapq.merge(candidates, recent_iter(await match_recents(session, input, NickOrUser.NICK, False)))
+                    heapq.merge(
+                        candidates, recent_iter(await match_recents(session, input, NickOrUser.NICK, False, limit))
+                    )
                 ),
                 limit,
             )
@@ -352,8 +556,8 @@ async def select_candidates(limit: int, input: str, guild: Guild, session: Async
                 unique_candidates(
                     heapq.merge(
                         candidates,
-                        recent_iter(await match_recents(session, input, NickOrUser.USER, True)),
-                        recent_iter(await match_recents(session, input, NickOrUser.NICK, True)),
+                        recent_iter(await match_recents(session, input, NickOrUser.USER, True, limit)),
+                        recent_iter(await match_recents(session, input, NickOrUser.NICK, True, limit)),
                     )
                 ),
                 limit,
@@ -364,19 +568,31 @@ async def select_candidates(limit: int, input: str, guild: Guild, session: Async
     return candidates
 
 
-async def match_recents(session: AsyncSession, text: str, nu: NickOrUser, infix: bool) -> Sequence[Recent]:
+async def match_recents(session: AsyncSession, text: str, nu: NickOrUser, infix: bool, limit: int) -> Sequence[Recent]:
+    """
+    Find the best matching past username or nickname of each user, ordered by exact matches first, then by length. The
+    conditions are served by the trigram indexes on log.users and log.nicks.
+    """
     if nu == NickOrUser.NICK:
         idcol = plugins.log.SavedNick.id
         matchcol = func.lower(plugins.log.SavedNick.nick)
     else:
         idcol = plugins.log.SavedUser.id
-        matchcol = func.lower(plugins.log.SavedUser.username + "#" + plugins.log.SavedUser.discrim)
+        matchcol = func.lower(plugins.log.SavedUser.username + literal_column("'#'") + plugins.log.SavedUser.discrim)
+    text = text.lower()
     if infix:
-        matchcond = func.strpos(matchcol, text.lower()) > 0
+        matchcond = matchcol.contains(text, autoescape=True)
     else:
-        matchcond = func.substring(matchcol, 1, len(text)) == text.lower()
-
-    stmt = select(idcol, matchcol).where(matchcond)
+        matchcond = matchcol.startswith(text, autoescape=True)
+
+    best = (
+        select(idcol.label("id"), matchcol.label("match"))
+        .where(matchcond)
+        .distinct(idcol)
+        .order_by(idcol, matchcol != text, func.length(matchcol))
+        .subquery()
+    )
+    stmt = select(best.c.id, best.c.match).order_by(best.c.match != text, func.length(best.c.match)).limit(limit)
     results = []
     for id, match in await session.execute(stmt):
         results.append((id, match, nu, infix))
@@ -429,11 +645,46 @@ async def whois_command(interaction: Interaction, user: str) -> None:
         embed.add_field(name="Created", value="<t:{}:f>, <t:{}:R>".format(created_at, created_at))
         embed.set_thumbnail(url=m.display_avatar.url)
 
-    await interaction.followup.send(content, embed=embed, ephemeral=True)
-
+    # Gather the rest of the information on separate connections while the profile is being sent, and send each
+    # section as soon as it's ready
+    sections = [
+        asyncio.create_task(tickets_section(id)),
+        asyncio.create_task(messages_section(id)),
+        asyncio.create_task(usernames_section(id, m)),
+        asyncio.create_task(nicknames_section(id, m)),
+    ]
+    try:
+        await interaction.followup.send(content, embed=embed, ephemeral=True)
+        for section in asyncio.as_completed(sections):
+            for content, _ in chunk_messages(await section):
+                await interaction.followup.send(content, suppress_embeds=True, ephemeral=True)
+    finally:
+        for section in sections:
+            section.cancel()
+
+
+async def tickets_section(id: int) -> List[PlainItem]:
     async with plugins.tickets.sessionmaker() as session:
         tickets = await plugins.tickets.visible_tickets(session, id)
 
+    items = []
+    for ticket in tickets:
+        items.append(PlainItem(", " if items else "**Outstanding tickets**\n"))
+        items.append(
+            PlainItem(
+                format(
+                    "[#{}]({}): {} ({})",
+                    ticket.id,
+                    ticket.jump_link,
+                    ticket.describe(target=False, mod=False, dm=False),
+                    ticket.status_line,
+                )
+            )
+        )
+    return items
+
+
+async def messages_section(id: int) -> List[PlainItem]:
     async with plugins.log.sessionmaker() as session:
         stmt = (
             select(plugins.log.SavedMessage)
@@ -442,41 +693,15 @@ async def whois_command(interaction: Interaction, user: str) -> None:
             .limit(15)
         )
         msgs = reversed(list((await session.execute(stmt)).scalars()))
-        stmt = select(plugins.log.SavedUser).where(plugins.log.SavedUser.id == id)
-        users = list((await session.execute(stmt)).scalars())
-        stmt = select(plugins.log.SavedNick.nick).where(
-            plugins.log.SavedNick.id == id, plugins.log.SavedNick.nick != None
-        )
-        nicks = list((await session.execute(stmt)).scalars())
 
-    def item_gen() -> Iterator[PlainItem]:
-        first = True
-        for ticket in tickets:
-            if first:
-                yield PlainItem("**Outstanding tickets**\n")
-            else:
-                yield PlainItem(", ")
-            first = False
-            yield PlainItem(
-                format(
-                    "[#{}]({}): {} ({})",
-                    ticket.id,
-                    ticket.jump_link,
-                    ticket.describe(target=False, mod=False, dm=False),
-                    ticket.status_line,
-                )
-            )
-        first = True
-        for msg in msgs:
-            if first:
-                yield PlainItem("\n\n**Recent messages**\n")
-            else:
-                yield PlainItem("\n")
-            first = False
-            created_at = int(snowflake_time(msg.id).timestamp())
-            content = msg.content.decode("utf8")
-            link = client.get_partial_messageable(msg.channel_id).get_partial_message(msg.id).jump_url
-            yield PlainItem(
+    items = []
+    for msg in msgs:
+        items.append(PlainItem("\n" if items else "**Recent messages**\n"))
+        created_at = int(snowflake_time(msg.id).timestamp())
+        content = plugins.log.decode_content(msg.content)
+        link = client.get_partial_messageable(msg.channel_id).get_partial_message(msg.id).jump_url
+        items.append(
+            PlainItem(
                 format(
                     "{!c} <t:{}:R> [{!i}{}]({})",
                     msg.channel_id,
@@ -486,35 +711,44 @@ async def whois_command(interaction: Interaction, user: str) -> None:
                     link,
                 )
             )
-        first = True
-        seen = set()
-        if m:
-            seen.add((m.name, m.discriminator))
-        for user in users:
-            if (user.username, user.discrim) not in seen:
-                seen.add((user.username, user.discrim))
-                if first:
-                    yield PlainItem("\n\n**Past usernames**\n")
-                else:
-                    yield PlainItem(", ")
-                first = False
-                yield PlainItem(format("{!i}#{!i}", user.username, user.discrim))
-        first = True
-        seen = set()
-        if isinstance(m, Member) and m.nick is not None:
-            seen.add(m.nick)
-        for nick in nicks:
-            if not nick in seen:
-                seen.add(nick)
-                if first:
-                    yield PlainItem("\n\n**Past nicknames**\n")
-                else:
-                    yield PlainItem(", ")
-                first = False
-                yield PlainItem(format("{!i}", nick))
+        )
+    return items
+
 
-    for content, _ in chunk_messages(item_gen()):
-        await interaction.followup.send(content, suppress_embeds=True, ephemeral=True)
+async def usernames_section(id: int, m: Optional[Union[Member, User]]) -> List[PlainItem]:
+    async with plugins.log.sessionmaker() as session:
+        stmt = select(plugins.log.SavedUser).where(plugins.log.SavedUser.id == id)
+        users = list((await session.execute(stmt)).scalars())
+
+    items = []
+    seen = set()
+    if m:
+        seen.add((m.name, m.discriminator))
+    for user in users:
+        if (user.username, user.discrim) not in seen:
+            seen.add((user.username, user.discrim))
+            items.append(PlainItem(", " if items else "**Past usernames**\n"))
+            items.append(PlainItem(format("{!i}#{!i}", user.username, user.discrim)))
+    return items
+
+
+async def nicknames_section(id: int, m: Optional[Union[Member, User]]) -> List[PlainItem]:
+    async with plugins.log.sessionmaker() as session:
+        stmt = select(plugins.log.SavedNick.nick).where(
+            plugins.log.SavedNick.id == id, plugins.log.SavedNick.nick != None
+        )
+        nicks = list((await session.execute(stmt)).scalars())
+
+    items = []
+    seen = set()
+    if isinstance(m, Member) and m.nick is not None:
+        seen.add(m.nick)
+    for nick in nicks:
+        if not nick in seen:
+            seen.add(nick)
+            items.append(PlainItem(", " if items else "**Past nicknames**\n"))
+            items.append(PlainItem(format("{!i}", nick)))
+    return items
 
 
 def format_server_status(server_status: ServerStatus) -> str:
@@ -584,19 +818,121 @@ def format_match(rank: MatchRank, match: Union[Member, Recent], guild: Guild) ->
             return "{} ??? \uFF5C aka: {} \uFF5C ({}) [{}]".format(id, aka, sstat, mtype)
 
 
+def rank_member(input: str, member: Member) -> Optional[MatchRank]:
+    """Rank a member against the input the same way select_candidates would, or return None if it doesn't match"""
+    text = input.lower()
+    server_status = rank_server_status(member)
+    ranks: List[MatchRank] = []
+    if str(member.id) == input:
+        ranks.append((MatchType.EXACT_ID,))
+    elif str(member.id).startswith(input):
+        ranks.append((MatchType.PREFIX_ID, server_status, member.id))
+    for name, nu in (
+        (member.name + "#" + member.discriminator, NickOrUser.USER),
+        (member.display_name, NickOrUser.NICK),
+        (member.nick, NickOrUser.NICK),
+    ):
+        if name is None or (pos := name.lower().find(text)) < 0:
+            continue
+        if len(name) == len(text):
+            ranks.append((MatchType.EXACT_USER if nu == NickOrUser.USER else MatchType.EXACT_NICK, server_status))
+        elif pos == 0:
+            ranks.append((MatchType.PREFIX, len(name) - len(text), nu, server_status))
+        else:
+            ranks.append((MatchType.INFIX, len(name) - len(text), nu, server_status))
+    return min(ranks, default=None)
+
+
+def refine_candidates(input: str, candidates: Sequence[Candidate]) -> Optional[List[Candidate]]:
+    """
+    Given the complete list of candidates for a prefix of the input, compute the candidates for the input, or return
+    None if that is not possible.
+    """
+    text = input.lower()
+    refined = []
+    for candidate in candidates:
+        if isinstance(candidate.match, Member):
+            if (rank := rank_member(input, candidate.match)) is not None:
+                refined.append(Candidate(rank, candidate.match))
+        else:
+            id, match, nu, _ = candidate.match
+            if (pos := match.find(text)) < 0:
+                # Only the best past name of the user was kept, another one could still match
+                return None
+            recent = (id, match, nu, pos > 0)
+            # Past name matches are ranked by server status last
+            server_status = cast(ServerStatus, candidate.rank[-1])
+            refined.append(Candidate(rank_recent_match(input, recent, server_status), recent))
+    refined.sort()
+    return refined
+
+
+# Autocomplete requests of a user in a guild for successive inputs reuse the previous results when the new input
+# extends the old one, as long as the previous results were complete, i.e. not cut off by the limit. A request that is
+# superseded by a newer one from the same user in the same guild is cancelled, as its response would be discarded
+# anyway.
+AUTOCOMPLETE_LIMIT: int = 25
+AUTOCOMPLETE_EXPIRY: float = 60
+
+
+@dataclass
+class AutocompleteSession:
+    input: str
+    candidates: Optional[Sequence[Candidate]]
+    expires: float
+    lookup: Optional[asyncio.Task[Sequence[Candidate]]] = None
+
+
+# Keyed by guild ID and user ID, as the candidates depend on the guild
+autocomplete_sessions: Dict[Tuple[int, int], AutocompleteSession] = {}
+
+
+async def lookup_candidates(input: str, guild: Guild) -> Sequence[Candidate]:
+    async with plugins.log.sessionmaker() as session:
+        return await select_candidates(AUTOCOMPLETE_LIMIT, input, guild, session)
+
+
+async def autocomplete_candidates(user_id: int, input: str, guild: Guild) -> Sequence[Candidate]:
+    now = monotonic()
+    for key in [key for key, session in autocomplete_sessions.items() if session.expires < now]:
+        del autocomplete_sessions[key]
+
+    key = (guild.id, user_id)
+    if (previous := autocomplete_sessions.get(key)) is not None:
+        if previous.lookup is not None:
+            previous.lookup.cancel()
+        if (
+            previous.candidates is not None
+            and len(previous.candidates) < AUTOCOMPLETE_LIMIT
+            and input.lower().startswith(previous.input.lower())
+            and (candidates := refine_candidates(input, previous.candidates)) is not None
+        ):
+            logger.debug("Refined {} candidates to {}".format(len(previous.candidates), len(candidates)))
+            autocomplete_sessions[key] = AutocompleteSession(input, candidates, now + AUTOCOMPLETE_EXPIRY)
+            return candidates
+
+    lookup = asyncio.create_task(lookup_candidates(input, guild))
+    autocomplete_sessions[key] = current = AutocompleteSession(input, None, now + AUTOCOMPLETE_EXPIRY, lookup)
+    await asyncio.wait((lookup,))
+    if lookup.cancelled():
+        return []
+    current.candidates = lookup.result()
+    current.lookup = None
+    return current.candidates
+
+
 @whois_command.autocomplete("user")
 async def whois_autocomplete(interaction: Interaction, input: str) -> List[Choice[str]]:
     assert (guild := interaction.guild) is not None
-    logger.debug("Start autocomplete")
+    start = perf_counter()
     if not input:
         results = []
     else:
-        async with plugins.log.sessionmaker() as session:
-            results = [
-                Choice(name=format_match(c.rank, c.match, guild), value=str(match_id(c.match)))
-                for c in await select_candidates(25, input, guild, session)
-            ]
-    logger.debug("End autocomplete")
+        results = [
+            Choice(name=format_match(c.rank, c.match, guild), value=str(match_id(c.match)))
+            for c in await autocomplete_candidates(interaction.user.id, input, guild)
+        ]
+    logger.debug("Autocomplete for {!r} took {:.3f}s".format(input, perf_counter() - start))
     return results
 
 
@@ -608,86 +944,105 @@ class Whois(Cog):
     """Maintain username cache"""
 
     async def cog_load(self) -> None:
-        await self.on_ready()
+        if client.is_ready():
+            await self.on_ready()
 
     @Cog.listener()
     async def on_ready(self) -> None:
-        global id_trie, username_trie, displayname_trie, nickname_trie, filling_event
+        global filling_event, snapshot_dirty
         filling_event.set()
         filling_event = threading.Event()
 
-        id_trie = IdTrie()
-        username_trie = InfixTrie()
-        displayname_trie = InfixTrie()
-        nickname_trie = InfixTrie()
-
-        def fill_trie(
+        def reconcile_indices(
             event: threading.Event,
             id_trie: IdTrie,
-            username_trie: InfixTrie,
-            displayname_trie: InfixTrie,
-            nickname_trie: InfixTrie,
+            username_index: NameIndex,
+            displayname_index: NameIndex,
+            nickname_indices: Dict[int, NameIndex],
             members: List[Member],
         ) -> None:
-            logger.debug("Starting to fill tries")
-            i = 0
+            logger.debug("Starting to reconcile indices")
+            start = perf_counter()
+            id_trie.reconcile(member.id for member in members)
+            nicknames: Dict[int, List[Tuple[str, int]]] = {}
             for member in members:
-                if event.is_set():
-                    break
-                id_trie.insert(member.id)
-                username_trie.insert(member.name + "#" + member.discriminator, member.id)
-                if member.global_name is not None:
-                    displayname_trie.insert(member.global_name, member.id)
+                guild_nicknames = nicknames.setdefault(member.guild.id, [])
                 if member.nick is not None:
-                    nickname_trie.insert(member.nick, member.id)
-
-                i += 1
-                if i % 10000 == 0:
-                    logger.debug("Filling tries: {}".format(i))
-            logger.debug("Done filling tries")
+                    guild_nicknames.append((member.nick, member.id))
+            for guild_id in set(nickname_indices) - set(nicknames):
+                del nickname_indices[guild_id]
+            changes = 0
+            for index, items in itertools.chain(
+                (
+                    (username_index, ((member.name + "#" + member.discriminator, member.id) for member in members)),
+                    (displayname_index, ((member.global_name, member.id) for member in members if member.global_name)),
+                ),
+                ((nickname_indices.setdefault(guild_id, NameIndex()), items) for guild_id, items in nicknames.items()),
+            ):
+                if event.is_set():
+                    return
+                changes += index.reconcile(items)
+            logger.debug("Reconciled indices with {} changes in {:.3f}s".format(changes, perf_counter() - start))
 
-        asyncio.get_event_loop().run_in_executor(
+        snapshot_dirty = True
+        await asyncio.get_event_loop().run_in_executor(
             None,
-            fill_trie,
+            reconcile_indices,
             filling_event,
             id_trie,
-            username_trie,
-            displayname_trie,
-            nickname_trie,
+            username_index,
+            displayname_index,
+            nickname_indices,
             list(client.get_all_members()),
         )
 
     @Cog.listener()
     async def on_member_join(self, member: Member) -> None:
+        global snapshot_dirty
+        snapshot_dirty = True
         id_trie.insert(member.id)
-        username_trie.insert(member.name + "#" + member.discriminator, member.id)
+        username_index.insert(member.name + "#" + member.discriminator, member.id)
         if member.global_name is not None:
-            displayname_trie.insert(member.global_name, member.id)
+            displayname_index.insert(member.global_name, member.id)
         if member.nick is not None:
-            nickname_trie.insert(member.nick, member.id)
+            get_nickname_index(member.guild.id).insert(member.nick, member.id)
 
     @Cog.listener()
     async def on_raw_member_remove(self, payload: RawMemberRemoveEvent) -> None:
+        global snapshot_dirty
+        snapshot_dirty = True
         id_trie.insert(payload.user.id)
-        username_trie.delete(payload.user.name + "#" + payload.user.discriminator, payload.user.id)
+        username_index.delete(payload.user.name + "#" + payload.user.discriminator, payload.user.id)
         if payload.user.global_name is not None:
-            displayname_trie.delete(payload.user.global_name, payload.user.id)
+            displayname_index.delete(payload.user.global_name, payload.user.id)
         if isinstance(payload.user, Member) and payload.user.nick is not None:
-            nickname_trie.delete(payload.user.nick, payload.user.id)
+            if (nickname_index := nickname_indices.get(payload.guild_id)) is not None:
+                nickname_index.delete(payload.user.nick, payload.user.id)
 
     @Cog.listener()
     async def on_member_update(self, before: Member, after: Member) -> None:
+        global snapshot_dirty
+        snapshot_dirty = True
         if before.nick != after.nick:
+            nickname_index = get_nickname_index(after.guild.id)
             if before.nick is not None:
-                nickname_trie.delete(before.nick, before.id)
+                nickname_index.delete(before.nick, before.id)
             if after.nick is not None:
-                nickname_trie.insert(after.nick, after.id)
+                nickname_index.insert(after.nick, after.id)
+
+    @Cog.listener()
+    async def on_guild_remove(self, guild: Guild) -> None:
+        global snapshot_dirty
+        snapshot_dirty = True
+        nickname_indices.pop(guild.id, None)
 
     @Cog.listener()
     async def on_user_update(self, before: User, after: User) -> None:
+        global snapshot_dirty
+        snapshot_dirty = True
         if before.name != after.name or before.discriminator != after.discriminator:
-            username_trie.delete(before.name + "#" + before.discriminator, before.id)
-            username_trie.insert(after.name + "#" + after.discriminator, after.id)
+            username_index.delete(before.name + "#" + before.discriminator, before.id)
+            username_index.insert(after.name + "#" + after.discriminator, after.id)
         if before.display_name != after.display_name:
-            displayname_trie.delete(before.display_name, before.id)
-            displayname_trie.insert(after.display_name, after.id)
+            displayname_index.delete(before.display_name, before.id)
+            displayname_index.insert(after.display_name, after.id)
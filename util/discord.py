@@ -5,8 +5,10 @@ Some common utilities for interacting with discord.
 from __future__ import annotations
 
 import asyncio
+from bisect import bisect_left, insort
 from datetime import datetime, timedelta, timezone
 from io import BytesIO
+from itertools import islice
 import logging
 import math
 import re
@@ -24,6 +26,7 @@ from typing import (
     Optional,
     Protocol,
     Sequence,
+    Set,
     Tuple,
     Type,
     TypeVar,
@@ -41,6 +44,7 @@ from discord import (
     Message,
     Object,
     PartialMessage,
+    RawMemberRemoveEvent,
     Role,
     StageChannel,
     TextChannel,
@@ -64,6 +68,7 @@ import discord.ext.commands.view
 from discord.ext.commands.view import StringView
 
 from bot.client import client
+from bot.cogs import Cog, cog
 
 
 logger: logging.Logger = logging.getLogger(__name__)
@@ -426,6 +431,159 @@ def named_priority(x: NamedType, s: str) -> Optional[int]:
         return None
 
 
+class MemberIndex:
+    """
+    An index of the names and nicknames of the members of a guild, answering the same question as priority_find with
+    nicknamed_priority without computing the priority of every member. Names are kept verbatim for exact matches, and
+    lowercased both in a dict for case-insensitive matches and in a sorted list for prefix matches. Infix matches scan
+    the lowercased names, which is still much cheaper than looking at the member objects.
+    """
+
+    __slots__ = "names", "exact", "folded", "prefixes"
+    names: Dict[int, Tuple[str, ...]]
+    exact: Dict[str, Set[int]]
+    folded: Dict[str, Set[int]]
+    prefixes: List[Tuple[str, int]]
+
+    def __init__(self, members: Iterable[Member]) -> None:
+        self.names = {}
+        self.exact = {}
+        self.folded = {}
+        self.prefixes = []
+        for member in members:
+            self.insert(member, sort=False)
+        self.prefixes.sort()
+
+    def insert(self, member: Member, *, sort: bool = True) -> None:
+        self.remove(member.id)
+        names = (member.name,) if member.nick is None else (member.name, member.nick)
+        self.names[member.id] = names
+        for name in names:
+            self.exact.setdefault(name, set()).add(member.id)
+        for name in set(name.lower() for name in names):
+            self.folded.setdefault(name, set()).add(member.id)
+            if sort:
+                insort(self.prefixes, (name, member.id))
+            else:
+                self.prefixes.append((name, member.id))
+
+    def remove(self, id: int) -> None:
+        if (names := self.names.pop(id, None)) is None:
+            return
+        for name in names:
+            if (ids := self.exact.get(name)) is not None:
+                ids.discard(id)
+                if not ids:
+                    del self.exact[name]
+        for name in set(name.lower() for name in names):
+            if (ids := self.folded.get(name)) is not None:
+                ids.discard(id)
+                if not ids:
+                    del self.folded[name]
+            i = bisect_left(self.prefixes, (name, id))
+            if i < len(self.prefixes) and self.prefixes[i] == (name, id):
+                del self.prefixes[i]
+
+    def find(self, s: str) -> Tuple[Optional[int], List[int]]:
+        """
+        Find the members for which nicknamed_priority returns the highest rank. Returns the rank, and up to two of the
+        matching member IDs, which is enough to tell a unique result from an ambiguous one.
+        """
+        if ids := self.exact.get(s):
+            return 3, list(islice(ids, 2))
+        s = s.lower()
+        if ids := self.folded.get(s):
+            return 2, list(islice(ids, 2))
+        found: List[int] = []
+        for name, id in islice(self.prefixes, bisect_left(self.prefixes, (s,)), None):
+            if not name.startswith(s):
+                break
+            if id not in found:
+                found.append(id)
+                if len(found) > 1:
+                    break
+        if found:
+            return 1, found
+        for name, ids in self.folded.items():
+            if s in name:
+                found.extend(id for id in ids if id not in found)
+                if len(found) > 1:
+                    return 0, found[:2]
+        if found:
+            return 0, found
+        return None, []
+
+
+member_indices: Dict[int, MemberIndex] = {}
+
+
+def get_member_index(guild: Guild) -> Optional[MemberIndex]:
+    """
+    Get the member index of the guild, building it if necessary. Returns None if the member list of the guild hasn't
+    been received yet.
+    """
+    if (index := member_indices.get(guild.id)) is None:
+        if not guild.chunked:
+            return None
+        index = member_indices[guild.id] = MemberIndex(guild.members)
+    return index
+
+
+def find_members(guild: Guild, s: str) -> List[Member]:
+    """
+    Find the members of the guild for which nicknamed_priority returns the highest rank, same as priority_find would.
+    A unique result is looked up in the member index, we only scan the member list if the result is ambiguous.
+    """
+    if (index := get_member_index(guild)) is not None:
+        rank, ids = index.find(s)
+        if rank is None:
+            return []
+        if len(ids) == 1:
+            if (member := guild.get_member(ids[0])) is not None and nicknamed_priority(member, s) == rank:
+                return [member]
+            logger.warning("Member index for {} is out of date, rebuilding".format(guild.id))
+            del member_indices[guild.id]
+    return priority_find(lambda m: nicknamed_priority(m, s), guild.members)
+
+
+@cog
+class MemberIndexCog(Cog):
+    """Keep the member indices up to date"""
+
+    @Cog.listener()
+    async def on_ready(self) -> None:
+        # We may have missed events, the indices will be rebuilt from the member cache when needed
+        member_indices.clear()
+
+    @Cog.listener()
+    async def on_guild_remove(self, guild: Guild) -> None:
+        member_indices.pop(guild.id, None)
+
+    @Cog.listener()
+    async def on_member_join(self, member: Member) -> None:
+        if (index := member_indices.get(member.guild.id)) is not None:
+            index.insert(member)
+
+    @Cog.listener()
+    async def on_raw_member_remove(self, payload: RawMemberRemoveEvent) -> None:
+        if (index := member_indices.get(payload.guild_id)) is not None:
+            index.remove(payload.user.id)
+
+    @Cog.listener()
+    async def on_member_update(self, before: Member, after: Member) -> None:
+        if before.name != after.name or before.nick != after.nick:
+            if (index := member_indices.get(after.guild.id)) is not None:
+                index.insert(after)
+
+    @Cog.listener()
+    async def on_user_update(self, before: User, after: User) -> None:
+        if before.name != after.name:
+            for guild in after.mutual_guilds:
+                if (index := member_indices.get(guild.id)) is not None:
+                    if (member := guild.get_member(after.id)) is not None:
+                        index.insert(member)
+
+
 # Argument converters for various Discord datatypes
 # We inherit XCoverter from X, so that given a declaration x: XConverter could be used with the assumption that really
 # at runtime x: X
@@ -443,21 +601,29 @@ class PartialUserConverter(Snowflake):
             return Object(int(match[0]))
 
         user_list: Sequence[Union[User, Member]]
+        index: Optional[MemberIndex] = None
         if ctx.guild is not None:
             user_list = ctx.guild.members
+            index = get_member_index(ctx.guild)
             where = "on this server"
         else:
             user_list = [cast(User, ctx.bot.user), ctx.author]
             where = "in this DM"
         if match := cls.discrim_re.fullmatch(arg):
             name, discrim = match[1], match[2]
-            matches = list(filter(lambda u: u.name == name and u.discriminator == discrim, user_list))
+            candidates: Iterable[Union[User, Member, None]] = user_list
+            if ctx.guild is not None and index is not None:
+                candidates = [ctx.guild.get_member(id) for id in index.exact.get(name, ())]
+            matches = [u for u in candidates if u is not None and u.name == name and u.discriminator == discrim]
             if len(matches) > 1:
                 raise BadArgument(format("Multiple users match {}#{} {}", name, discrim, where))
             elif len(matches) == 1:
                 return matches[0]
 
-        matches = priority_find(lambda u: nicknamed_priority(u, arg), user_list)
+        if ctx.guild is not None:
+            matches = find_members(ctx.guild, arg)
+        else:
+            matches = priority_find(lambda u: nicknamed_priority(u, arg), user_list)
         if len(matches) > 1:
             raise BadArgument(format("Multiple users match {} {}", arg, where))
         elif len(matches) == 1: